@@ -13,6 +13,8 @@ def main() -> None:
         port=config.server.port,
         ssl_certfile=config.server.cert_file,
         ssl_keyfile=config.server.key_file,
+        loop="uvloop",
+        http="httptools",
     )
 
 
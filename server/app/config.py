@@ -3,13 +3,17 @@ from __future__ import annotations
 import os
 from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import IO, Any, Optional
 
-import yaml
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
-class ServerConfig(BaseModel):
+class _FrozenModel(BaseModel):
+    # configuration is read-only once loaded; frozen models are also hashable
+    model_config = ConfigDict(frozen=True)
+
+
+class ServerConfig(_FrozenModel):
     host: str = Field(default="0.0.0.0")
     port: int = Field(default=8443)
     api_token: str
@@ -19,22 +23,34 @@ class ServerConfig(BaseModel):
     manifest_ttl_seconds: int = Field(default=300)
     poll_interval_minutes: int = Field(default=10)
     max_firmware_size_kb: int = Field(default=3900)
+    download_log_batch_size: int = Field(default=1000)
+    download_log_flush_ms: int = Field(default=200)
+    worker_threads: int = Field(default=40, ge=1)
 
 
-class SchedulerConfig(BaseModel):
+class SchedulerConfig(_FrozenModel):
     timezone: str = Field(default="UTC")
     schedules_file: str = Field(default="config/schedules.yaml")
 
 
-class DatabaseConfig(BaseModel):
+class DatabaseConfig(_FrozenModel):
     url: str = Field(default="sqlite:///./ota.db")
-
-
-class LoggingConfig(BaseModel):
+    pool_size: int = Field(default=20)
+    max_overflow: int = Field(default=10)
+    pool_timeout: int = Field(default=30)
+    pool_recycle: int = Field(default=1800)
+    pool_pre_ping: bool = Field(default=True)
+    query_cache_size: int = Field(default=1200)
+    # off by default: WAL keeps commits in a -wal file beside the database, which a
+    # single-file bind mount (as in docker-compose.yml) does not persist
+    sqlite_wal: bool = Field(default=False)
+
+
+class LoggingConfig(_FrozenModel):
     level: str = Field(default="INFO")
 
 
-class AppConfig(BaseModel):
+class AppConfig(_FrozenModel):
     server: ServerConfig
     scheduler: SchedulerConfig
     database: DatabaseConfig
@@ -97,18 +113,34 @@ def _resolve_sqlite_url(url: str, *, base_dir: Path) -> str:
 
 def _normalize_paths(config: AppConfig, *, config_path: Path) -> AppConfig:
     base_dir = _config_base_dir(config_path)
-    config.server.cert_file = _resolve_path(config.server.cert_file, base_dir=base_dir)
-    config.server.key_file = _resolve_path(config.server.key_file, base_dir=base_dir)
-    config.server.storage_root = _resolve_path(config.server.storage_root, base_dir=base_dir)
-    config.scheduler.schedules_file = _resolve_path(config.scheduler.schedules_file, base_dir=base_dir)
-    config.database.url = _resolve_sqlite_url(config.database.url, base_dir=base_dir)
-    return config
+    server = config.server.model_copy(
+        update={
+            "cert_file": _resolve_path(config.server.cert_file, base_dir=base_dir),
+            "key_file": _resolve_path(config.server.key_file, base_dir=base_dir),
+            "storage_root": _resolve_path(config.server.storage_root, base_dir=base_dir),
+        }
+    )
+    scheduler = config.scheduler.model_copy(
+        update={"schedules_file": _resolve_path(config.scheduler.schedules_file, base_dir=base_dir)}
+    )
+    database = config.database.model_copy(
+        update={"url": _resolve_sqlite_url(config.database.url, base_dir=base_dir)}
+    )
+    return config.model_copy(update={"server": server, "scheduler": scheduler, "database": database})
+
+
+def load_yaml(stream: IO[str]) -> Any:
+    # imported on first use so processes that never parse YAML skip loading PyYAML
+    import yaml
+
+    # libyaml's C loader is several times faster; fall back when PyYAML was built without it
+    return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
 
 def load_config(path: Optional[Path] = None) -> AppConfig:
     config_path = path or _default_config_path()
     with open(config_path, "r", encoding="utf-8") as fh:
-        raw = yaml.safe_load(fh)
+        raw = load_yaml(fh)
     config = AppConfig.model_validate(raw)
     return _normalize_paths(config, config_path=config_path)
 
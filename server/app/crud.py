@@ -1,40 +1,198 @@
 from __future__ import annotations
 
 import logging
-from datetime import datetime
-from typing import Iterable
-
-from packaging.version import Version
-from sqlalchemy import and_, or_, select
-from sqlalchemy.exc import NoResultFound
-from sqlalchemy.orm import Session
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from cachetools import LRUCache, TTLCache
+from packaging.version import InvalidVersion, Version
+from sqlalchemy import and_, bindparam, delete, event, func, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlalchemy.orm import Session, joinedload, selectinload
 
 from . import models
+from .config import get_config
 
 logger = logging.getLogger(__name__)
 
+# phase digit after the release: dev-only releases sort first, final releases after pre-releases
+_SORTKEY_PRE_PHASES = {"a": "1", "b": "2", "rc": "3"}
+# must match the length of Firmware.version_sortkey
+_SORTKEY_MAX_LENGTH = 64
+
+_MANIFEST_CACHE_MISS = object()
+
+
+class ManifestChoice(NamedTuple):
+    firmware_id: int
+    version: str
+    sha256: str
+    size_bytes: int
+    release_notes: str | None
+    rollout_id: int
+    rollout_name: str
+
+
+class FirmwareFile(NamedTuple):
+    id: int
+    path: Path
+    sha256: str
+    size_bytes: int
+
+
+_manifest_cache: TTLCache = TTLCache(maxsize=4096, ttl=get_config().server.manifest_ttl_seconds)
+_manifest_cache_lock = threading.Lock()
+_manifest_cache_generation = 0
+# firmware rows are never updated or deleted, so entries stay valid for the process lifetime
+_firmware_files: dict[str, FirmwareFile] = {}
+# normalized MAC -> device id; ids never change, and a deleted device is evicted on first miss
+_device_ids: LRUCache = LRUCache(maxsize=4096)
+_device_ids_lock = threading.Lock()
+
+_UPSERT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def _upsert_insert(session: Session, model: type[models.Base]):
+    """Return an ``INSERT ... ON CONFLICT`` construct, or ``None`` if the dialect has none."""
+    upsert_insert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    return None if upsert_insert is None else upsert_insert(model)
+
+
+def _insert_ignoring_conflicts(
+    session: Session, model: type[models.Base], rows: list[dict], *, index_elements: list
+) -> None:
+    """Insert ``rows``, skipping any that already exist, e.g. from a concurrent check-in."""
+    statement = _upsert_insert(session, model)
+    if statement is not None:
+        session.execute(statement.on_conflict_do_nothing(index_elements=index_elements), rows)
+        return
+    # other dialects: one savepoint per row, so a conflicting row is rolled back on its own
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.execute(insert(model), [row])
+        except IntegrityError:
+            logger.debug("%s row %s already exists; skipping", model.__name__, row)
+
+
+def _sortable_int(value: int) -> str:
+    # length-prefixed so shorter numbers sort first; lengths above 8 take a "9" and two digits
+    digits = str(value)
+    prefix = str(len(digits)) if len(digits) < 9 else f"9{len(digits):02d}"
+    return prefix + digits
+
+
+# sized for distinct device-reported versions, not just the firmware catalogue; versions
+# that cannot be encoded are cached as None, so a device reporting one is not re-parsed
+@lru_cache(maxsize=4096)
+def _encode_version(version: str) -> str | None:
+    try:
+        parsed = Version(version)
+    except InvalidVersion:
+        return None
+    release = list(parsed.release)
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()  # 1.0 == 1.0.0
+    # "0" ends the release and sorts below every length prefix, so 1.0.0.0.1 > 1
+    parts = [_sortable_int(parsed.epoch), *(_sortable_int(part) for part in release), "0"]
+    if parsed.pre is not None:
+        parts.append(_SORTKEY_PRE_PHASES[parsed.pre[0]] + _sortable_int(parsed.pre[1]))
+    elif parsed.dev is not None and parsed.post is None:
+        parts.append("0")  # 1.0.dev1 sorts before 1.0a1
+    else:
+        parts.append("4")
+    parts.append("0" if parsed.post is None else "1" + _sortable_int(parsed.post))
+    parts.append("2" if parsed.dev is None else "1" + _sortable_int(parsed.dev))
+    key = "".join(parts)
+    return key if len(key) <= _SORTKEY_MAX_LENGTH else None
+
+
+def version_sortkey(version: str) -> str:
+    """Encode a PEP 440 version as a string that sorts like ``packaging.Version``.
+
+    The key is made of digits only, so it orders the same under any database collation.
+    Local version labels are ignored.
+
+    Args:
+        version: Version string such as ``"1.2.3"``, ``"1.3.0rc1"`` or ``"20241015.1"``.
+
+    Returns:
+        Key whose lexical order matches version order, usable in SQL ``ORDER BY``.
+
+    Raises:
+        ValueError: If the version is invalid or its key does not fit the database column.
+    """
+    key = _encode_version(version)
+    if key is None:
+        raise ValueError(f"Version {version} cannot be encoded as a sort key")
+    return key
+
+
+def clear_manifest_cache() -> None:
+    global _manifest_cache_generation
+    with _manifest_cache_lock:
+        _manifest_cache.clear()
+        _manifest_cache_generation += 1
+    logger.debug("Cleared manifest cache")
+
+
+def _clear_manifest_cache_on_commit(session: Session) -> None:
+    # clearing before the commit would let a concurrent check-update read the old rollouts
+    # and cache them under the new generation
+    session.info["manifest_cache_stale"] = True
+
+
+def _after_commit(session: Session) -> None:
+    if session.info.pop("manifest_cache_stale", False):
+        clear_manifest_cache()
+
+
+def _after_rollback(session: Session) -> None:
+    session.info.pop("manifest_cache_stale", None)
+
+
+event.listen(Session, "after_commit", _after_commit)
+event.listen(Session, "after_rollback", _after_rollback)
+
+
+def clear_lookup_caches() -> None:
+    """Forget cached firmware files and device ids, e.g. after rows were deleted."""
+    _firmware_files.clear()
+    with _device_ids_lock:
+        _device_ids.clear()
+
+
+def _remember_device_id(mac: str, device_id: int) -> None:
+    with _device_ids_lock:
+        _device_ids[mac] = device_id
+
+
+def forget_device_id(mac: str) -> None:
+    with _device_ids_lock:
+        _device_ids.pop(mac, None)
+
 
 def _ensure_labels(session: Session, label_names: Iterable[str]) -> list[models.Label]:
-    labels: list[models.Label] = []
     normalized = {name.strip() for name in label_names if name and name.strip()}
     if not normalized:
         logger.debug("No label names supplied; skipping label creation")
         return []
-    existing = {
-        label.name: label
-        for label in session.execute(
-            select(models.Label).where(models.Label.name.in_(normalized))
-        ).scalars()
-    }
-    for name in normalized:
-        label = existing.get(name)
-        if not label:
-            logger.debug("Creating new label '%s'", name)
-            label = models.Label(name=name)
-            session.add(label)
-            session.flush()
-        labels.append(label)
-    return labels
+    query = select(models.Label).where(models.Label.name.in_(normalized))
+    existing = {label.name: label for label in session.execute(query).scalars()}
+    missing = normalized - existing.keys()
+    if missing:
+        logger.debug("Creating new labels: %s", ", ".join(sorted(missing)))
+        _insert_ignoring_conflicts(
+            session, models.Label, [{"name": name} for name in missing], index_elements=[models.Label.name]
+        )
+        existing = {label.name: label for label in session.execute(query).scalars()}
+    return list(existing.values())
 
 
 def register_or_update_device(
@@ -45,47 +203,107 @@ def register_or_update_device(
     current_version: str,
     label_names: Iterable[str],
     meta: dict | None = None,
-) -> models.Device:
+) -> tuple[models.Device, set[str]]:
+    """Create or update a device from a check-in.
+
+    Returns:
+        The device and the names of the labels it carries after the update.
+    """
     labels = _ensure_labels(session, label_names)
     device = session.execute(
-        select(models.Device).where(models.Device.mac == mac)
+        select(models.Device)
+        .options(selectinload(models.Device.labels).joinedload(models.DeviceLabel.label))
+        .where(models.Device.mac == mac)
     ).scalar_one_or_none()
 
-    if not device:
+    is_new = device is None
+    if is_new:
         logger.debug("Registering new device with MAC %s", mac)
         device = models.Device(mac=mac)
         session.add(device)
         session.flush()
+        # a cached id would belong to a deleted device registered under this MAC before
+        forget_device_id(mac)
     else:
         logger.debug("Updating existing device with MAC %s", mac)
+        _remember_device_id(mac, device.id)
 
     device.ip = ip
     device.current_version = current_version
-    device.last_seen = datetime.utcnow()
+    device.last_seen = func.now()
     device.meta = meta or {}
 
-    # update labels
-    existing_label_ids = {dl.label_id for dl in device.labels}
-    for label in labels:
-        if label.id not in existing_label_ids:
-            device.labels.append(models.DeviceLabel(device=device, label=label))
-            logger.debug("Assigned label '%s' to device %s", label.name, mac)
-    # remove labels not in provided list only if we have explicit set
+    # replace labels only when an explicit set was provided
     if labels:
-        session.flush()
         desired_ids = {label.id for label in labels}
-        device.labels[:] = [
-            dl for dl in device.labels if dl.label_id in desired_ids
-        ]
+        existing_label_ids = set() if is_new else {dl.label_id for dl in device.labels}
+        added = desired_ids - existing_label_ids
         removed = existing_label_ids - desired_ids
         if removed:
+            session.execute(
+                delete(models.DeviceLabel).where(
+                    models.DeviceLabel.device_id == device.id,
+                    models.DeviceLabel.label_id.notin_(desired_ids),
+                )
+            )
             logger.debug("Removed %d labels from device %s", len(removed), mac)
+        if added:
+            # concurrent check-ins for the same device may race on the same rows
+            _insert_ignoring_conflicts(
+                session,
+                models.DeviceLabel,
+                [{"device_id": device.id, "label_id": label_id} for label_id in added],
+                index_elements=[models.DeviceLabel.device_id, models.DeviceLabel.label_id],
+            )
+            logger.debug("Assigned %d labels to device %s", len(added), mac)
+        if added or removed:
+            session.expire(device, ["labels"])
+        device_label_names = {label.name for label in labels}
+    elif is_new:
+        device_label_names = set()
+    else:
+        device_label_names = {dl.label.name for dl in device.labels}
+
+    return device, device_label_names
+
 
-    return device
+def get_report_ids(session: Session, *, mac: str, version: str) -> tuple[int | None, int | None]:
+    """Resolve the device and firmware ids for a status report.
 
+    Known devices and firmware are answered from the lookup caches; otherwise both ids
+    are read in one query. Each id is ``None`` when the device or firmware is unknown.
+    """
+    with _device_ids_lock:
+        cached_device_id = _device_ids.get(mac)
+    firmware_file = _firmware_files.get(version)
+    if cached_device_id is not None and firmware_file is not None:
+        return cached_device_id, firmware_file.id
+    device_id = select(models.Device.id).where(models.Device.mac == mac).scalar_subquery()
+    firmware_id = select(models.Firmware.id).where(models.Firmware.version == version).scalar_subquery()
+    row = session.execute(select(device_id, firmware_id)).one()
+    if row[0] is not None:
+        _remember_device_id(mac, row[0])
+    return row[0], row[1]
 
-def list_device_labels(device: models.Device) -> set[str]:
-    return {dl.label.name for dl in device.labels}
+
+def touch_device(session: Session, device_id: int, *, current_version: str | None = None) -> bool:
+    """Refresh ``last_seen`` and optionally the installed version.
+
+    Returns:
+        ``False`` if the device no longer exists.
+    """
+    values: dict = {"last_seen": func.now()}
+    if current_version is not None:
+        values["current_version"] = current_version
+    # no RETURNING: MySQL and SQLite before 3.35 do not support it on UPDATE
+    result = session.execute(update(models.Device).where(models.Device.id == device_id).values(**values))
+    return result.rowcount > 0
+
+
+def get_device_version(session: Session, device_id: int) -> str | None:
+    return session.execute(
+        select(models.Device.current_version).where(models.Device.id == device_id)
+    ).scalar_one_or_none()
 
 
 def get_firmware_by_version(session: Session, version: str) -> models.Firmware | None:
@@ -94,6 +312,27 @@ def get_firmware_by_version(session: Session, version: str) -> models.Firmware |
     ).scalar_one_or_none()
 
 
+def get_firmware_file(session: Session, version: str) -> FirmwareFile | None:
+    cached = _firmware_files.get(version)
+    if cached is not None:
+        return cached
+    row = session.execute(
+        select(
+            models.Firmware.id, models.Firmware.file_path, models.Firmware.sha256, models.Firmware.size_bytes
+        ).where(models.Firmware.version == version)
+    ).one_or_none()
+    if row is None:
+        # not cached: the firmware may still be uploaded by the CLI
+        return None
+    path = Path(row.file_path)
+    if not path.is_absolute():
+        # rows stored before paths were canonicalised at upload
+        path = path.resolve()
+    firmware_file = FirmwareFile(row.id, path, row.sha256, row.size_bytes)
+    _firmware_files[version] = firmware_file
+    return firmware_file
+
+
 def create_firmware(
     session: Session,
     *,
@@ -117,6 +356,7 @@ def create_firmware(
         sha256=sha256,
         release_notes=release_notes,
         pilot_ready=pilot_ready,
+        version_sortkey=version_sortkey(version),
     )
     session.add(firmware)
     session.flush()
@@ -148,6 +388,7 @@ def create_rollout(
     )
     session.add(rollout)
     session.flush()
+    _clear_manifest_cache_on_commit(session)
     return rollout
 
 
@@ -171,116 +412,182 @@ def set_rollout_status(
         status,
         rollout.is_active,
     )
-    rollout.start_at = rollout.start_at or (datetime.utcnow() if rollout.is_active else rollout.start_at)
+    if rollout.start_at is None and rollout.is_active:
+        rollout.start_at = func.now()
     if status == models.RolloutStatus.completed:
-        rollout.end_at = datetime.utcnow()
+        rollout.end_at = func.now()
     session.flush()
+    _clear_manifest_cache_on_commit(session)
     return rollout
 
 
-def ensure_schedule(
-    session: Session,
-    *,
-    name: str,
-    rollout: models.Rollout,
-    cron: str,
-    enabled: bool,
-) -> models.Schedule:
-    schedule = session.execute(
-        select(models.Schedule).where(models.Schedule.name == name)
-    ).scalar_one_or_none()
-    if schedule:
-        logger.debug("Updating schedule '%s' (enabled=%s cron=%s)", name, enabled, cron)
-        schedule.cron = cron
-        schedule.enabled = enabled
-        schedule.rollout = rollout
-    else:
-        logger.debug(
-            "Creating schedule '%s' for rollout '%s' with cron '%s' (enabled=%s)",
-            name,
-            rollout.name,
-            cron,
-            enabled,
-        )
-        schedule = models.Schedule(name=name, cron=cron, enabled=enabled, rollout=rollout)
-        session.add(schedule)
-    session.flush()
-    return schedule
+def get_rollouts_by_names(session: Session, names: Iterable[str]) -> dict[str, models.Rollout]:
+    wanted = set(names)
+    if not wanted:
+        return {}
+    return {
+        rollout.name: rollout
+        for rollout in session.execute(
+            select(models.Rollout).where(models.Rollout.name.in_(wanted))
+        ).scalars()
+    }
+
+
+def upsert_schedules(session: Session, rows: list[dict]) -> None:
+    """Insert or update schedules, in a single statement where the dialect supports it.
+
+    Args:
+        session: Active database session.
+        rows: Mappings with ``name``, ``cron``, ``enabled`` and ``rollout_id`` keys.
+    """
+    if not rows:
+        logger.debug("No schedules to upsert")
+        return
+    statement = _upsert_insert(session, models.Schedule)
+    if statement is None:
+        _update_or_insert_schedules(session, rows)
+        return
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.Schedule.name],
+        set_={
+            "cron": statement.excluded.cron,
+            "enabled": statement.excluded.enabled,
+            "rollout_id": statement.excluded.rollout_id,
+        },
+    )
+    session.execute(statement, rows)
+    logger.debug("Upserted %d schedules", len(rows))
+
+
+def _update_or_insert_schedules(session: Session, rows: list[dict]) -> None:
+    # fallback for dialects without ON CONFLICT; schedules are only synced by the scheduler
+    table = models.Schedule.__table__
+    names = [row["name"] for row in rows]
+    existing = set(session.execute(select(table.c.name).where(table.c.name.in_(names))).scalars())
+    updates = [
+        {"match_name": row["name"], "cron": row["cron"], "enabled": row["enabled"], "rollout_id": row["rollout_id"]}
+        for row in rows
+        if row["name"] in existing
+    ]
+    inserts = [row for row in rows if row["name"] not in existing]
+    if updates:
+        # every key other than match_name becomes a SET column
+        session.connection().execute(update(table).where(table.c.name == bindparam("match_name")), updates)
+    if inserts:
+        session.execute(insert(models.Schedule), inserts)
+    logger.debug("Updated %d and inserted %d schedules", len(updates), len(inserts))
 
 
 def record_download(
     session: Session,
     *,
-    device: models.Device,
-    firmware: models.Firmware,
+    device_id: int,
+    firmware_id: int,
     status: models.DownloadStatus,
     error: str | None = None,
-) -> models.DownloadLog:
-    entry = models.DownloadLog(device=device, firmware=firmware, status=status, error=error)
-    session.add(entry)
-    session.flush()
-    return entry
+) -> None:
+    insert_download_logs(
+        session, [{"device_id": device_id, "firmware_id": firmware_id, "status": status, "error": error}]
+    )
 
 
-def find_active_rollouts_for_labels(
-    session: Session,
-    *,
-    label_names: Iterable[str],
-) -> list[models.Rollout]:
-    labels = set(label_names)
-    query = select(models.Rollout).join(models.Firmware)
-    conditions = [models.Rollout.is_active.is_(True), models.Rollout.status == models.RolloutStatus.active]
-    if labels:
-        logger.debug("Filtering active rollouts by labels: %s", ", ".join(sorted(labels)))
-        query = query.outerjoin(models.Label, models.Rollout.target_label)
-        label_condition = or_(
-            models.Rollout.target_label_id.is_(None),
-            models.Label.name.in_(labels),
+def insert_download_logs(session: Session, rows: list[dict]) -> None:
+    session.execute(insert(models.DownloadLog), rows)
+    logger.debug("Inserted %d download log entries", len(rows))
+
+
+def choose_manifest_row(session: Session, *, device: models.Device) -> ManifestChoice | None:
+    """Select the newest firmware offered to a device in one statement, as a plain row.
+
+    The device's labels are resolved inside the query through ``device_labels``; a device
+    without labels is treated as carrying the ``general`` label.
+    """
+    current_key = _encode_version(device.current_version) if device.current_version else None
+    if device.current_version and current_key is None:
+        # without a key nothing can be shown to be newer; never risk offering a downgrade
+        logger.debug(
+            "Device %s current version '%s' cannot be ranked; no update offered",
+            device.mac,
+            device.current_version,
         )
-        conditions.append(label_condition)
+        return None
+    device_label_ids = select(models.DeviceLabel.label_id).where(models.DeviceLabel.device_id == device.id)
+    conditions = [
+        # "= 1" rather than is_(True)'s "IS 1", which SQLite will not match to ix_rollouts_active
+        models.Rollout.is_active == True,  # noqa: E712
+        models.Rollout.status == models.RolloutStatus.active,
+        or_(
+            models.Rollout.target_label_id.is_(None),
+            models.Rollout.target_label_id.in_(device_label_ids),
+            and_(~device_label_ids.exists(), models.Label.name == "general"),
+        ),
+    ]
+    if current_key is not None:
+        conditions.append(models.Firmware.version_sortkey > current_key)
     else:
-        logger.debug("No labels provided; returning rollouts without label restrictions")
-        conditions.append(models.Rollout.target_label_id.is_(None))
-    return list(session.execute(query.where(and_(*conditions))).scalars())
+        # firmware whose version could not be encoded has no place in the order
+        conditions.append(models.Firmware.version_sortkey.is_not(None))
+    query = (
+        select(
+            models.Firmware.id,
+            models.Firmware.version,
+            models.Firmware.sha256,
+            models.Firmware.size_bytes,
+            models.Firmware.release_notes,
+            models.Rollout.id,
+            models.Rollout.name,
+        )
+        .join(models.Rollout, models.Rollout.firmware_id == models.Firmware.id)
+        .outerjoin(models.Label, models.Rollout.target_label_id == models.Label.id)
+        .where(*conditions)
+        .order_by(models.Firmware.version_sortkey.desc())
+        .limit(1)
+    )
+    row = session.execute(query).first()
+    if row is None:
+        logger.debug("No rollout offers firmware newer than %s to device %s", device.current_version, device.mac)
+        return None
+    choice = ManifestChoice(*row)
+    logger.debug(
+        "Selecting firmware %s from rollout '%s' for device %s",
+        choice.version,
+        choice.rollout_name,
+        device.mac,
+    )
+    return choice
 
 
 def choose_manifest_for_device(
     session: Session,
     *,
     device: models.Device,
-) -> tuple[models.Firmware | None, models.Rollout | None]:
-    device_labels = list_device_labels(device)
-    rollouts = find_active_rollouts_for_labels(session, label_names=device_labels or {"general"})
-    try:
-        current_version = Version(device.current_version) if device.current_version else None
-    except Exception:  # pragma: no cover - invalid version strings
-        logger.debug("Device %s current version '%s' invalid; treating as None", device.mac, device.current_version)
-        current_version = None
-    selected_firmware: models.Firmware | None = None
-    selected_rollout: models.Rollout | None = None
-
-    for rollout in rollouts:
-        fw = rollout.firmware
-        fw_version = Version(fw.version)
-        if current_version and fw_version <= current_version:
-            logger.debug(
-                "Skipping rollout '%s' for device %s; firmware %s <= current version %s",
-                rollout.name,
-                device.mac,
-                fw.version,
-                current_version,
-            )
-            continue
-        if not selected_firmware or Version(selected_firmware.version) < fw_version:
-            logger.debug(
-                "Selecting firmware %s from rollout '%s' for device %s",
-                fw.version,
-                rollout.name,
-                device.mac,
-            )
-            selected_firmware = fw
-            selected_rollout = rollout
-    return selected_firmware, selected_rollout
+    labels: set[str],
+) -> ManifestChoice | None:
+    """Pick the firmware to offer a device, served from a TTL cache when possible.
+
+    Results are keyed by the device's label set and current version, so every device
+    sharing them reuses one lookup until ``manifest_ttl_seconds`` expires or a session that
+    changed a rollout commits (see ``clear_manifest_cache``).
+
+    Args:
+        session: Active database session.
+        device: Device being served.
+        labels: The device's label names, as returned by ``register_or_update_device``.
+    """
+    # the label names are only needed for the cache key; the query resolves labels itself
+    key = (frozenset(labels), device.current_version)
+    with _manifest_cache_lock:
+        cached = _manifest_cache.get(key, _MANIFEST_CACHE_MISS)
+        generation = _manifest_cache_generation
+    if cached is not _MANIFEST_CACHE_MISS:
+        logger.debug("Manifest cache hit for device %s", device.mac)
+        return cached
+    choice = choose_manifest_row(session, device=device)
+    with _manifest_cache_lock:
+        # a rollout changed while we were querying; don't cache a possibly stale answer
+        if generation == _manifest_cache_generation:
+            _manifest_cache[key] = choice
+    return choice
 
 
 def get_label(session: Session, name: str) -> models.Label:
@@ -295,11 +602,42 @@ def get_label(session: Session, name: str) -> models.Label:
 
 
 def list_devices(session: Session) -> list[models.Device]:
-    return list(session.execute(select(models.Device)).scalars())
+    query = select(models.Device).options(
+        selectinload(models.Device.labels).joinedload(models.DeviceLabel.label)
+    )
+    return list(session.execute(query).scalars())
 
 
 def list_rollouts(session: Session) -> list[models.Rollout]:
-    return list(session.execute(select(models.Rollout)).scalars())
+    query = select(models.Rollout).options(
+        joinedload(models.Rollout.firmware),
+        joinedload(models.Rollout.target_label),
+    )
+    return list(session.execute(query).scalars())
+
+
+def backfill_version_sortkeys(session: Session) -> int:
+    """Fill in missing version sort keys and re-encode keys written in an older format.
+
+    Firmware whose version cannot be encoded keeps a ``NULL`` key, is logged and is never
+    offered to devices; it does not stop startup.
+
+    Returns:
+        The number of firmware rows whose key was updated.
+    """
+    count = 0
+    for firmware in session.execute(select(models.Firmware)).scalars():
+        try:
+            key = version_sortkey(firmware.version)
+        except ValueError:
+            logger.warning("Firmware %s has no valid sort key and will not be offered", firmware.version)
+            key = None
+        if firmware.version_sortkey != key:
+            firmware.version_sortkey = key
+            count += 1
+    if count:
+        logger.info("Backfilled version sort keys for %d firmware builds", count)
+    return count
 
 
 def list_firmware(session: Session) -> list[models.Firmware]:
@@ -1,25 +1,106 @@
 from __future__ import annotations
 
+import logging
 from contextlib import contextmanager
+from typing import Any
 
-from sqlalchemy import create_engine
+from sqlalchemy import Connection, create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
 
-from .config import get_config
+from .config import DatabaseConfig, get_config
+
+
+logger = logging.getLogger(__name__)
+
+
+def _engine_options(database: DatabaseConfig) -> dict[str, Any]:
+    if database.url.startswith("sqlite"):
+        if make_url(database.url).database in (None, "", ":memory:"):
+            # Every connection to :memory: is a new empty database, so share a single one.
+            # For tests only: request threads and the DownloadLogWriter thread then use the
+            # same DBAPI connection, so a timed writer commit would commit (or roll back) a
+            # request's transaction mid-flight. The test config therefore stretches
+            # download_log_flush_ms and flushes the writer between requests. A shared-cache
+            # memory URI is no way out: its writers fail with SQLITE_LOCKED instead of waiting.
+            return {"connect_args": {"check_same_thread": False}, "poolclass": StaticPool}
+        # SQLite connections are local file handles; the default pool needs no sizing.
+        return {"connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": database.pool_size,
+        "max_overflow": database.max_overflow,
+        "pool_timeout": database.pool_timeout,
+        "pool_recycle": database.pool_recycle,
+    }
 
 
 config = get_config()
-connect_args = {"check_same_thread": False} if config.database.url.startswith("sqlite") else {}
-engine = create_engine(config.database.url, connect_args=connect_args, future=True)
+engine = create_engine(
+    config.database.url,
+    pool_pre_ping=config.database.pool_pre_ping,
+    query_cache_size=config.database.query_cache_size,
+    future=True,
+    **_engine_options(config.database),
+)
+# WAL lets device polls read while a check-in writes; NORMAL sync is durable in WAL mode
+_SQLITE_WAL_PRAGMAS = ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL")
+# journal_mode is stored in the database file, so switching WAL off has to be explicit
+_SQLITE_ROLLBACK_PRAGMAS = ("PRAGMA journal_mode=DELETE",)
+_SQLITE_PRAGMAS = ("PRAGMA mmap_size=268435456", "PRAGMA temp_store=MEMORY")
+
+
+def _sqlite_connect_listener(database: DatabaseConfig):
+    pragmas = (_SQLITE_WAL_PRAGMAS if database.sqlite_wal else _SQLITE_ROLLBACK_PRAGMAS) + _SQLITE_PRAGMAS
+
+    def configure(dbapi_connection: Any, _connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+    return configure
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", _sqlite_connect_listener(config.database))
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False, future=True)
 
 Base = declarative_base()
 
 
+def _upgrade_schema(connection: Connection) -> None:
+    """Add nullable columns and indexes introduced after a table was first created."""
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                logger.warning("Cannot add non-nullable column %s.%s automatically", table.name, column.name)
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(
+                text(f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}")
+            )
+            logger.info("Added column %s.%s", table.name, column.name)
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
 def init_db() -> None:
-    from . import models  # noqa: F401 - ensure models are imported for metadata
+    from . import crud, models  # noqa: F401 - ensure models are imported for metadata
 
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        _upgrade_schema(connection)
+    with session_scope() as session:
+        crud.backfill_version_sortkeys(session)
 
 
 @contextmanager
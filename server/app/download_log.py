@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any
+
+from sqlalchemy.orm import Session
+
+from . import crud, models
+from .config import get_config
+from .database import session_scope
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadLogWriter:
+    """Buffer download log entries and insert them in batches from a background task.
+
+    Request handlers run in the threadpool and hand entries over with ``record`` once
+    their own transaction has committed; the writer task drains up to
+    ``download_log_batch_size`` entries or waits at most ``download_log_flush_ms`` before
+    writing them with one INSERT. When the writer is not running (CLI, scheduler jobs)
+    entries are written and committed through the caller's session.
+    """
+
+    def __init__(self) -> None:
+        config = get_config()
+        self.batch_size = config.server.download_log_batch_size
+        self.flush_interval = config.server.download_log_flush_ms / 1000
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue[dict[str, Any]] | None = None
+        self._task: asyncio.Task | None = None
+        self._batch: list[dict[str, Any]] = []
+        # serialises writes so flush() also waits for a batch the task is already writing
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running:
+            logger.debug("Download log writer already running; start skipped")
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = self._loop.create_task(self._run())
+        logger.info("Download log writer started (batch_size=%d)", self.batch_size)
+
+    async def shutdown(self) -> None:
+        if not self._task:
+            logger.debug("Download log writer not running; shutdown skipped")
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        logger.info("Download log writer stopped")
+
+    def record(
+        self,
+        session: Session,
+        *,
+        device_id: int,
+        firmware_id: int,
+        status: models.DownloadStatus,
+        error: str | None = None,
+    ) -> None:
+        """Log a download event for a device and firmware that are already committed.
+
+        The background writer inserts from its own session, so a row queued before the
+        caller's commit could reference a device that does not exist yet.
+        """
+        if not self.running:
+            crud.record_download(session, device_id=device_id, firmware_id=firmware_id, status=status, error=error)
+            session.commit()
+            return
+        row = {"device_id": device_id, "firmware_id": firmware_id, "status": status, "error": error}
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, row)
+
+    async def flush(self) -> None:
+        """Write everything buffered so far, including entries still queued."""
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._batch.append(self._queue.get_nowait())
+        await self._write_batch()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # await before touching self._batch: flush() may swap the list while we wait
+            row = await self._queue.get()
+            self._batch.append(row)
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self._batch.append(row)
+            await self._write_batch()
+
+    async def _write_batch(self) -> None:
+        async with self._write_lock:
+            batch, self._batch = self._batch, []
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self._insert, batch)
+            except Exception:
+                logger.exception("Failed to write %d download log entries; retrying one by one", len(batch))
+                await asyncio.to_thread(self._insert_each, batch)
+
+    @staticmethod
+    def _insert(rows: list[dict[str, Any]]) -> None:
+        with session_scope() as session:
+            crud.insert_download_logs(session, rows)
+
+    @classmethod
+    def _insert_each(cls, rows: list[dict[str, Any]]) -> None:
+        # keep the writer alive and lose only the rows the database rejects
+        for row in rows:
+            try:
+                cls._insert([row])
+            except Exception:
+                logger.exception("Dropping download log entry %s", row)
@@ -1,29 +1,34 @@
 from __future__ import annotations
 
 import logging
-from datetime import datetime
-from pathlib import Path
-from typing import Annotated
+from contextlib import asynccontextmanager
+from typing import Annotated, AsyncIterator
 
 from logging.config import dictConfig
 
+import anyio.to_thread
 from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
-from fastapi.responses import FileResponse
-from sqlalchemy import select
+from fastapi.responses import FileResponse, ORJSONResponse
 from sqlalchemy.orm import Session
 
 from . import crud, models
 from .config import get_config
 from .database import get_session, init_db
+from .download_log import DownloadLogWriter
 from .manifest import build_manifest
 from .scheduler import RolloutScheduler
-from .schemas import CheckUpdateRequest, CheckUpdateResponse, ReportStatusRequest
+from .schemas import (
+    CheckUpdateRequest,
+    CheckUpdateResponse,
+    DeviceState,
+    ReportStatusRequest,
+    ReportStatusResponse,
+)
 from .security import get_poll_interval_minutes, verify_api_token
 from .storage import ensure_storage_root
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="ESP32 OTA Server", version="1.0")
 _config = get_config()
 
 
@@ -85,19 +90,32 @@ def _configure_logging(level: str) -> None:
 
 _configure_logging(_config.logging.level)
 _scheduler = RolloutScheduler()
+_download_log_writer = DownloadLogWriter()
 
 
-@app.on_event("startup")
-async def on_startup() -> None:
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
     ensure_storage_root()
+    # create_all opens the first pooled connection, so the pool is warm before traffic arrives
     init_db()
+    # sync endpoints run in anyio's default thread pool; size it to match the database pool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = _config.server.worker_threads
     _scheduler.start()
+    _download_log_writer.start()
     logger.info("OTA server started on %s:%s", _config.server.host, _config.server.port)
+    try:
+        yield
+    finally:
+        _scheduler.shutdown()
+        await _download_log_writer.shutdown()
 
 
-@app.on_event("shutdown")
-async def on_shutdown() -> None:
-    _scheduler.shutdown()
+app = FastAPI(
+    title="ESP32 OTA Server",
+    version="1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 @app.get("/healthz")
@@ -117,7 +135,7 @@ def check_update(
     session: SessionDependency,
 ) -> CheckUpdateResponse:
     device_ip = request.client.host if request.client else None
-    device = crud.register_or_update_device(
+    device, labels = crud.register_or_update_device(
         session,
         mac=payload.mac,
         ip=device_ip,
@@ -125,40 +143,66 @@ def check_update(
         label_names=payload.labels,
         meta=payload.meta,
     )
-    firmware, rollout = crud.choose_manifest_for_device(session, device=device)
+    choice = crud.choose_manifest_for_device(session, device=device, labels=labels)
     poll_interval = get_poll_interval_minutes()
 
-    if not firmware:
+    if not choice:
         session.commit()
         logger.debug("No update available for device %s", payload.mac)
-        return CheckUpdateResponse(update_available=False, manifest=None, poll_interval_minutes=poll_interval)
+        return CheckUpdateResponse.model_construct(
+            update_available=False,
+            manifest=None,
+            poll_interval_minutes=poll_interval,
+        )
 
     logger.debug(
         "Preparing manifest for device %s with firmware %s (rollout=%s)",
         payload.mac,
-        firmware.version,
-        rollout.name if rollout else "n/a",
+        choice.version,
+        choice.rollout_name,
     )
-    manifest = build_manifest(request, firmware)
-    crud.record_download(session, device=device, firmware=firmware, status=models.DownloadStatus.downloading)
-    logger.info("Offering firmware %s to device %s (rollout=%s)", firmware.version, payload.mac, rollout.name if rollout else "n/a")
+    manifest = build_manifest(request, choice)
     session.commit()
-    return CheckUpdateResponse(update_available=True, manifest=manifest, poll_interval_minutes=poll_interval)
+    _download_log_writer.record(
+        session,
+        device_id=device.id,
+        firmware_id=choice.firmware_id,
+        status=models.DownloadStatus.downloading,
+    )
+    logger.info("Offering firmware %s to device %s (rollout=%s)", choice.version, payload.mac, choice.rollout_name)
+    return CheckUpdateResponse.model_construct(
+        update_available=True,
+        manifest=manifest,
+        poll_interval_minutes=poll_interval,
+    )
+
+
+FIRMWARE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
 
 
 @app.get("/firmware/{version}/image.bin", response_model=None)
 def download_firmware(
     version: str,
+    request: Request,
     _: TokenDependency,
     session: SessionDependency,
 ) -> Response:
-    firmware = session.execute(
-        select(models.Firmware).where(models.Firmware.version == version)
-    ).scalar_one_or_none()
+    firmware = crud.get_firmware_file(session, version)
     if not firmware:
         logger.debug("Firmware version %s requested but not found in database", version)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Firmware not found")
-    file_path = Path(firmware.file_path).resolve()
+    # Images are immutable per version, so the stored digest doubles as a strong validator
+    headers = {"ETag": f'"{firmware.sha256}"', "Cache-Control": FIRMWARE_CACHE_CONTROL}
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    file_path = firmware.path
     if not file_path.exists():
         logger.debug("Firmware file missing on disk for version %s at %s", version, file_path)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Firmware file missing")
@@ -166,6 +210,7 @@ def download_firmware(
         path=file_path,
         filename=file_path.name,
         media_type="application/octet-stream",
+        headers=headers,
     )
 
 
@@ -174,15 +219,12 @@ def report_status(
     payload: ReportStatusRequest,
     _: TokenDependency,
     session: SessionDependency,
-) -> dict[str, str]:
-    device = session.execute(
-        select(models.Device).where(models.Device.mac == payload.mac)
-    ).scalar_one_or_none()
-    if not device:
+) -> ReportStatusResponse:
+    device_id, firmware_id = crud.get_report_ids(session, mac=payload.mac, version=payload.firmware_version)
+    if device_id is None:
         logger.debug("Device %s attempted to report status but is not registered", payload.mac)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not registered")
-    firmware = crud.get_firmware_by_version(session, payload.firmware_version)
-    if not firmware:
+    if firmware_id is None:
         logger.debug(
             "Device %s reported status for unknown firmware %s",
             payload.mac,
@@ -198,12 +240,31 @@ def report_status(
             payload.firmware_version,
             payload.error,
         )
-    crud.record_download(session, device=device, firmware=firmware, status=status_value, error=payload.error)
-
-    if status_value == models.DownloadStatus.success:
-        device.current_version = payload.firmware_version
-        logger.debug("Updated device %s current version to %s", payload.mac, payload.firmware_version)
-    device.last_seen = datetime.utcnow()
+    installed_version = payload.firmware_version if status_value == models.DownloadStatus.success else None
+    touched = crud.touch_device(session, device_id, current_version=installed_version)
+    if not touched:
+        # the cached id belonged to a deleted device; the MAC may have registered again since
+        crud.forget_device_id(payload.mac)
+        device_id, _ = crud.get_report_ids(session, mac=payload.mac, version=payload.firmware_version)
+        if device_id is not None:
+            touched = crud.touch_device(session, device_id, current_version=installed_version)
+    if not touched:
+        logger.debug("Device %s attempted to report status but is no longer registered", payload.mac)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not registered")
+    if installed_version:
+        logger.debug("Updated device %s current version to %s", payload.mac, installed_version)
+    # a failed install leaves the stored version as it was
+    current_version = installed_version or crud.get_device_version(session, device_id)
     session.commit()
+    _download_log_writer.record(
+        session,
+        device_id=device_id,
+        firmware_id=firmware_id,
+        status=status_value,
+        error=payload.error,
+    )
     logger.info("Device %s reported %s for firmware %s", payload.mac, payload.status, payload.firmware_version)
-    return {"status": "ok"}
+    return ReportStatusResponse.model_construct(
+        status="ok",
+        device=DeviceState.model_construct(id=device_id, current_version=current_version),
+    )
@@ -1,9 +1,10 @@
 from __future__ import annotations
 
 from fastapi import Request
+from pydantic_core import Url
 
+from .crud import ManifestChoice
 from .schemas import Manifest
-from . import models
 
 
 def _forwarded_value(header_value: str | None) -> str | None:
@@ -40,12 +41,13 @@ def _external_host(request: Request) -> str:
     )
 
 
-def build_manifest(request: Request, firmware: models.Firmware) -> Manifest:
+def build_manifest(request: Request, firmware: ManifestChoice) -> Manifest:
     download_path = request.app.url_path_for("download_firmware", version=firmware.version)
     download_url = f"{_external_scheme(request)}://{_external_host(request)}{download_path}"
-    return Manifest(
+    # every field comes from our own database row, so skip re-validating it
+    return Manifest.model_construct(
         version=firmware.version,
-        url=download_url,
+        url=Url(download_url),
         sha256=firmware.sha256,
         size_bytes=firmware.size_bytes,
         release_notes=firmware.release_notes,
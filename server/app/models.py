@@ -10,9 +10,12 @@ from sqlalchemy import (
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
+    func,
+    text,
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -39,7 +42,9 @@ class Device(Base):
     mac: Mapped[str] = mapped_column(String(32), unique=True, index=True)
     ip: Mapped[str | None] = mapped_column(String(64), nullable=True)
     current_version: Mapped[str | None] = mapped_column(String(32), nullable=True)
-    last_seen: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    last_seen: Mapped[datetime] = mapped_column(
+        DateTime, default=func.now(), server_default=func.now(), onupdate=func.now(), nullable=False
+    )
     meta: Mapped[dict | None] = mapped_column(JSON, nullable=True)
 
     labels: Mapped[list["DeviceLabel"]] = relationship("DeviceLabel", back_populates="device", cascade="all, delete-orphan")
@@ -74,12 +79,13 @@ class Firmware(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     version: Mapped[str] = mapped_column(String(32), unique=True, index=True)
+    version_sortkey: Mapped[str | None] = mapped_column(String(64), nullable=True, index=True)
     channel: Mapped[str | None] = mapped_column(String(64), nullable=True)
     file_path: Mapped[str] = mapped_column(String(256), nullable=False)
     size_bytes: Mapped[int] = mapped_column(Integer, nullable=False)
     sha256: Mapped[str] = mapped_column(String(64), nullable=False)
     release_notes: Mapped[str | None] = mapped_column(String(1024), nullable=True)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), server_default=func.now(), nullable=False)
     pilot_ready: Mapped[bool] = mapped_column(Boolean, default=False)
 
     rollouts: Mapped[list["Rollout"]] = relationship("Rollout", back_populates="firmware")
@@ -88,6 +94,16 @@ class Firmware(Base):
 
 class Rollout(Base):
     __tablename__ = "rollouts"
+    __table_args__ = (
+        Index(
+            "ix_rollouts_active",
+            "is_active",
+            "status",
+            "target_label_id",
+            sqlite_where=text("is_active = 1"),
+            postgresql_where=text("is_active"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(64), unique=True, nullable=False)
@@ -123,12 +139,13 @@ class DownloadStatus(str, enum.Enum):
 
 class DownloadLog(Base):
     __tablename__ = "download_log"
+    __table_args__ = (Index("ix_download_log_device_created", "device_id", "created_at"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     device_id: Mapped[int] = mapped_column(ForeignKey("devices.id", ondelete="CASCADE"))
     firmware_id: Mapped[int] = mapped_column(ForeignKey("firmware.id", ondelete="CASCADE"))
     status: Mapped[DownloadStatus] = mapped_column(Enum(DownloadStatus), nullable=False)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), server_default=func.now(), nullable=False)
     error: Mapped[str | None] = mapped_column(String(512), nullable=True)
 
     device: Mapped[Device] = relationship(Device, back_populates="downloads")
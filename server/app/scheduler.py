@@ -1,17 +1,15 @@
 from __future__ import annotations
 
+import json
 import logging
 from pathlib import Path
 from typing import Any
 
-import yaml
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from sqlalchemy import select
-from sqlalchemy.orm import Session
 
 from . import crud, models
-from .config import get_config
+from .config import get_config, load_yaml
 from .database import SessionLocal
 
 logger = logging.getLogger(__name__)
@@ -22,6 +20,9 @@ class RolloutScheduler:
         config = get_config()
         self.scheduler = AsyncIOScheduler(timezone=config.scheduler.timezone)
         self.config = config
+        self._schedules_signature: tuple[int, int, bool] | None = None
+        self._applied_jobs: dict[str, tuple[int, str, bool]] = {}
+        self._triggers: dict[str, tuple[str, CronTrigger]] = {}
 
     def start(self) -> None:
         if not self.scheduler.running:
@@ -43,47 +44,67 @@ class RolloutScheduler:
         if not config_path.exists():
             logger.warning("Schedules file %s not found", config_path)
             return
+        stat = config_path.stat()
+        signature = (stat.st_mtime_ns, stat.st_size, apply_jobs)
+        if signature == self._schedules_signature:
+            logger.debug("Schedules file %s unchanged; refresh skipped", config_path)
+            return
         with config_path.open("r", encoding="utf-8") as fh:
-            data = yaml.safe_load(fh) or {}
+            # JSON is a subset of YAML, but the stdlib parser is much cheaper for generated files
+            data = (json.load(fh) if config_path.suffix == ".json" else load_yaml(fh)) or {}
         schedules: list[dict[str, Any]] = data.get("schedules", [])
         logger.debug("Loaded %d schedule definitions (apply_jobs=%s)", len(schedules), apply_jobs)
         known_job_ids = {job.id for job in self.scheduler.get_jobs()} if apply_jobs else set()
         desired_job_ids: set[str] = set()
 
+        # keyed by name so a repeated name is written once, last definition winning; a
+        # multi-row INSERT ... ON CONFLICT DO UPDATE cannot touch the same row twice
+        definitions: dict[str, tuple[str, str, bool]] = {}
+        for item in schedules:
+            name = item.get("name")
+            rollout_name = item.get("rollout")
+            cron_expression = item.get("cron")
+            enabled = bool(item.get("enabled", True))
+            if not name or not rollout_name or not cron_expression:
+                logger.warning("Invalid schedule definition: %s", item)
+                continue
+            if apply_jobs:
+                desired_job_ids.add(name)
+            else:
+                logger.debug("Dry-run refresh for schedule '%s'", name)
+            if name in definitions:
+                logger.warning("Schedule '%s' is defined more than once; using the last definition", name)
+            definitions[name] = (rollout_name, cron_expression, enabled)
+
+        resolved: list[tuple[str, str, int, str, bool]] = []
         with SessionLocal() as session:
-            for item in schedules:
-                name = item.get("name")
-                rollout_name = item.get("rollout")
-                cron_expression = item.get("cron")
-                enabled = bool(item.get("enabled", True))
-                if not name or not rollout_name or not cron_expression:
-                    logger.warning("Invalid schedule definition: %s", item)
-                    continue
-                if apply_jobs:
-                    desired_job_ids.add(name)
-                else:
-                    logger.debug("Dry-run refresh for schedule '%s'", name)
-                rollout = self._get_rollout_by_name(session, rollout_name)
+            rollouts = crud.get_rollouts_by_names(session, (definition[0] for definition in definitions.values()))
+            rows: list[dict[str, Any]] = []
+            for name, (rollout_name, cron_expression, enabled) in definitions.items():
+                rollout = rollouts.get(rollout_name)
                 if not rollout:
                     logger.warning("Rollout '%s' referenced by schedule '%s' not found", rollout_name, name)
                     continue
-                crud.ensure_schedule(
-                    session,
-                    name=name,
-                    rollout=rollout,
-                    cron=cron_expression,
-                    enabled=enabled,
-                )
-                if not apply_jobs:
+                rows.append({"name": name, "cron": cron_expression, "enabled": enabled, "rollout_id": rollout.id})
+                resolved.append((name, rollout_name, rollout.id, cron_expression, enabled))
+            crud.upsert_schedules(session, rows)
+            session.commit()
+
+        if apply_jobs:
+            for name, rollout_name, rollout_id, cron_expression, enabled in resolved:
+                job_spec = (rollout_id, cron_expression, enabled)
+                if self._applied_jobs.get(name) == job_spec and (not enabled or name in known_job_ids):
+                    logger.debug("Schedule '%s' unchanged; job left as is", name)
                     continue
+                self._applied_jobs[name] = job_spec
                 if enabled:
-                    trigger = CronTrigger.from_crontab(cron_expression, timezone=self.config.scheduler.timezone)
+                    trigger = self._trigger_for(name, cron_expression)
                     self.scheduler.add_job(
                         self.activate_rollout,
                         trigger=trigger,
                         id=name,
                         replace_existing=True,
-                        kwargs={"rollout_name": rollout_name},
+                        kwargs={"rollout_id": rollout_id},
                     )
                     logger.info("Scheduled rollout '%s' via job '%s'", rollout_name, name)
                 else:
@@ -96,10 +117,14 @@ class RolloutScheduler:
                         else:
                             logger.info("Removed disabled schedule '%s'", name)
                     logger.debug("Schedule '%s' is disabled; job not registered", name)
-            session.commit()
+
+        self._schedules_signature = signature
 
         # prune orphaned jobs not present anymore
         if apply_jobs:
+            for name in self._applied_jobs.keys() - desired_job_ids:
+                self._applied_jobs.pop(name, None)
+                self._triggers.pop(name, None)
             for job_id in known_job_ids - desired_job_ids:
                 try:
                     self.scheduler.remove_job(job_id=job_id)
@@ -109,21 +134,21 @@ class RolloutScheduler:
             if not desired_job_ids:
                 logger.debug("No schedules requested; all existing jobs considered stale")
 
-    @staticmethod
-    def _get_rollout_by_name(session: Session, name: str) -> models.Rollout | None:
-        return session.execute(
-            select(models.Rollout).where(models.Rollout.name == name)
-        ).scalar_one_or_none()
+    def _trigger_for(self, name: str, cron_expression: str) -> CronTrigger:
+        cached = self._triggers.get(name)
+        if cached and cached[0] == cron_expression:
+            return cached[1]
+        trigger = CronTrigger.from_crontab(cron_expression, timezone=self.config.scheduler.timezone)
+        self._triggers[name] = (cron_expression, trigger)
+        return trigger
 
     @staticmethod
-    def activate_rollout(*, rollout_name: str) -> None:
-        logger.info("Activating rollout '%s' via scheduler", rollout_name)
+    def activate_rollout(*, rollout_id: int) -> None:
+        logger.info("Activating rollout %d via scheduler", rollout_id)
         with SessionLocal() as session:
-            rollout = session.execute(
-                select(models.Rollout).where(models.Rollout.name == rollout_name)
-            ).scalar_one_or_none()
+            rollout = session.get(models.Rollout, rollout_id)
             if not rollout:
-                logger.warning("Rollout '%s' not found during activation", rollout_name)
+                logger.warning("Rollout %d not found during activation", rollout_id)
                 return
             crud.set_rollout_status(
                 session,
@@ -132,4 +157,4 @@ class RolloutScheduler:
                 is_active=True,
             )
             session.commit()
-            logger.info("Rollout '%s' is now active", rollout_name)
+            logger.info("Rollout '%s' is now active", rollout.name)
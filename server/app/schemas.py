@@ -6,6 +6,15 @@ from typing import Any
 from pydantic import BaseModel, Field, HttpUrl, field_validator
 from packaging.version import Version
 
+_MAC_STRIP = str.maketrans("", "", ":-")
+
+
+def _normalize_mac(value: str) -> str:
+    clean = value.translate(_MAC_STRIP).lower()
+    if len(clean) != 12:
+        raise ValueError("MAC address must be 12 hexadecimal characters")
+    return clean
+
 
 class CheckUpdateRequest(BaseModel):
     mac: str = Field(min_length=8, max_length=32)
@@ -16,10 +25,7 @@ class CheckUpdateRequest(BaseModel):
     @field_validator("mac")
     @classmethod
     def normalize_mac(cls, value: str) -> str:
-        clean = value.replace(":", "").replace("-", "").lower()
-        if len(clean) != 12:
-            raise ValueError("MAC address must be 12 hexadecimal characters")
-        return clean
+        return _normalize_mac(value)
 
 
 class Manifest(BaseModel):
@@ -49,10 +55,17 @@ class ReportStatusRequest(BaseModel):
     @field_validator("mac")
     @classmethod
     def normalize_mac(cls, value: str) -> str:
-        clean = value.replace(":", "").replace("-", "").lower()
-        if len(clean) != 12:
-            raise ValueError("MAC address must be 12 hexadecimal characters")
-        return clean
+        return _normalize_mac(value)
+
+
+class DeviceState(BaseModel):
+    id: int
+    current_version: str | None
+
+
+class ReportStatusResponse(BaseModel):
+    status: str
+    device: DeviceState
 
 
 class DeviceRead(BaseModel):
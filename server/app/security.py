@@ -1,13 +1,20 @@
 from __future__ import annotations
 
+import hmac
+from functools import lru_cache
+
 from fastapi import Depends, Header, HTTPException, status
 
 from .config import get_config
 
 
+@lru_cache(maxsize=1)
+def _api_token() -> bytes:
+    return get_config().server.api_token.encode()
+
+
 def verify_api_token(x_ota_token: str = Header(...)) -> str:
-    config = get_config()
-    if x_ota_token != config.server.api_token:
+    if not hmac.compare_digest(x_ota_token.encode(), _api_token()):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid OTA token")
     return x_ota_token
 
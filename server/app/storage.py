@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import hashlib
+import os
 import shutil
+import tempfile
 from pathlib import Path
 
 from .config import get_config
@@ -13,12 +15,7 @@ def ensure_storage_root() -> Path:
     return storage_root
 
 
-def compute_sha256(path: Path) -> str:
-    hasher = hashlib.sha256()
-    with path.open("rb") as fh:
-        for chunk in iter(lambda: fh.read(8192), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+HASH_BUFFER_SIZE = 1 << 20
 
 
 def store_firmware_file(source: Path, version: str) -> tuple[Path, int, str]:
@@ -26,14 +23,35 @@ def store_firmware_file(source: Path, version: str) -> tuple[Path, int, str]:
     storage_root = ensure_storage_root()
     target_dir = storage_root / version
     target_dir.mkdir(parents=True, exist_ok=True)
-    target_file = target_dir / source.name
-    shutil.copy2(source, target_file)
-    size_bytes = target_file.stat().st_size
+    # stored verbatim in Firmware.file_path, so downloads never need to resolve it
+    target_file = (target_dir / source.name).resolve()
+    if target_file.exists() and os.path.samefile(source, target_file):
+        raise shutil.SameFileError(f"{source} and {target_file} are the same file")
     max_bytes = config.server.max_firmware_size_kb * 1024
-    if size_bytes > max_bytes:
-        target_file.unlink(missing_ok=True)
-        raise ValueError(
-            f"Firmware file exceeds limit ({size_bytes} bytes > {max_bytes} bytes)"
-        )
-    sha256 = compute_sha256(target_file)
-    return target_file, size_bytes, sha256
+    hasher = hashlib.sha256()
+    size_bytes = 0
+    buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+    # copy, hash and size-check in one pass into a temporary file, so a failed or
+    # oversized upload never touches an image already stored under this name
+    fd, temp_name = tempfile.mkstemp(dir=target_dir, prefix=f".{source.name}.", suffix=".tmp")
+    temp_file = Path(temp_name)
+    try:
+        with source.open("rb", buffering=0) as src, os.fdopen(fd, "wb") as dst:
+            while size := src.readinto(buffer):
+                size_bytes += size
+                if size_bytes > max_bytes:
+                    break
+                chunk = buffer[:size]
+                hasher.update(chunk)
+                dst.write(chunk)
+        if size_bytes > max_bytes:
+            size_bytes = source.stat().st_size
+            raise ValueError(
+                f"Firmware file exceeds limit ({size_bytes} bytes > {max_bytes} bytes)"
+            )
+        shutil.copystat(source, temp_file)
+        os.replace(temp_file, target_file)
+    except BaseException:
+        temp_file.unlink(missing_ok=True)
+        raise
+    return target_file, size_bytes, hasher.hexdigest()
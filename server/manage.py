@@ -1,9 +1,9 @@
 from __future__ import annotations
 
-import json
 from pathlib import Path
 from typing import Optional
 
+import orjson
 import typer
 from packaging.version import Version, InvalidVersion
 from sqlalchemy import select
@@ -64,7 +64,7 @@ def label_assign(
             select(models.Device).where(models.Device.mac == mac)
         ).scalar_one_or_none()
         current_version = existing.current_version if existing else "0.0.0"
-        device = crud.register_or_update_device(
+        device, _ = crud.register_or_update_device(
             session,
             mac=mac,
             ip=None,
@@ -85,12 +85,12 @@ def device_list() -> None:
                 "mac": device.mac,
                 "ip": device.ip,
                 "current_version": device.current_version,
-                "labels": sorted(crud.list_device_labels(device)),
+                "labels": sorted(dl.label.name for dl in device.labels),
                 "last_seen": device.last_seen.isoformat(),
             }
             for device in crud.list_devices(session)
         ]
-    typer.echo(json.dumps(data, indent=2))
+    typer.echo(orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
 
 
 @app.command()
@@ -107,7 +107,7 @@ def firmware_list() -> None:
             }
             for fw in crud.list_firmware(session)
         ]
-    typer.echo(json.dumps(data, indent=2))
+    typer.echo(orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
 
 
 @app.command()
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from server.app import config as app_config
+
+# The app reads its configuration and builds the engine at import time, so the test
+# configuration has to be in place before any test module imports the rest of server.app.
+_TEST_ROOT = Path(tempfile.mkdtemp(prefix="ota-tests-"))
+
+
+def _build_test_config(root: Path) -> app_config.AppConfig:
+    config_dir = root / "config"
+    config_dir.mkdir()
+    cert_dir = root / "certs"
+    cert_dir.mkdir()
+    schedules_json = config_dir / "schedules.json"
+    schedules_json.write_text('{"schedules": []}', encoding="utf-8")
+
+    return app_config.AppConfig.model_validate(
+        {
+            "server": {
+                "host": "127.0.0.1",
+                "port": 8443,
+                "api_token": "test-token",
+                "cert_file": str(cert_dir / "server.crt"),
+                "key_file": str(cert_dir / "server.key"),
+                "storage_root": str(root / "storage"),
+                "manifest_ttl_seconds": 60,
+                "poll_interval_minutes": 5,
+                "max_firmware_size_kb": 3900,
+                # tests flush the download log explicitly; the in-memory database has a single
+                # connection, so keep the writer from committing underneath a running request
+                # (see database._engine_options). test_download_log.py covers the timed flush.
+                "download_log_flush_ms": 3_600_000,
+            },
+            "scheduler": {
+                "timezone": "UTC",
+                "schedules_file": str(schedules_json),
+            },
+            "database": {
+                "url": "sqlite://",
+            },
+            "logging": {
+                "level": "INFO",
+            },
+        }
+    )
+
+
+_TEST_CONFIG = _build_test_config(_TEST_ROOT)
+_config_patch = pytest.MonkeyPatch()
+_config_patch.setattr(app_config, "get_config", lambda: _TEST_CONFIG)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    _config_patch.undo()
+    shutil.rmtree(_TEST_ROOT, ignore_errors=True)
+
+
+# just under the 3900 KiB upload limit, so hashing cost resembles a real image
+SAMPLE_FIRMWARE_SIZE = 3_800_000
+
+
+@pytest.fixture(scope="session")
+def sample_firmware(tmp_path_factory):
+    """Store one firmware image for the whole session.
+
+    Returns:
+        The ``(stored_path, size_bytes, sha256)`` tuple from ``store_firmware_file``.
+    """
+    from server.app.storage import store_firmware_file
+
+    source = tmp_path_factory.mktemp("firmware") / "image.bin"
+    source.write_bytes(bytes(range(256)) * (SAMPLE_FIRMWARE_SIZE // 256))
+    return store_firmware_file(source, "sample")
+
+
+class DummyScheduler:
+    def start(self):
+        return None
+
+    def shutdown(self):
+        return None
+
+    def refresh_jobs(self, *args, **kwargs):
+        return None
+
+
+@pytest.fixture(scope="session")
+def app_client():
+    from server.app import main as app_main
+
+    app_main._scheduler = DummyScheduler()
+
+    with TestClient(app_main.app) as client:
+        yield client, app_main
+
+
+@pytest.fixture()
+def test_client(app_client):
+    client, app_main = app_client
+    yield client, app_main
+
+    from server.app import crud
+    from server.app.database import Base, engine
+
+    # write out anything still buffered, then empty every table for the next test
+    client.portal.call(app_main._download_log_writer.flush)
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    crud.clear_manifest_cache()
+    crud.clear_lookup_caches()
@@ -1,254 +1,383 @@
 from __future__ import annotations
 
-import importlib
-import json
-import os
-import sys
-from pathlib import Path
-
-import pytest
-from fastapi.testclient import TestClient
-from sqlalchemy import select
-
-
-@pytest.fixture()
-def test_client(tmp_path, monkeypatch):
-    config_dir = tmp_path / "config"
-    config_dir.mkdir()
-    storage_dir = tmp_path / "storage"
-    cert_dir = tmp_path / "certs"
-    cert_dir.mkdir()
-    schedules_yaml = config_dir / "schedules.yaml"
-    schedules_yaml.write_text("schedules: []\n", encoding="utf-8")
-
-    server_yaml = {
-        "server": {
-            "host": "127.0.0.1",
-            "port": 8443,
-            "api_token": "test-token",
-            "cert_file": str(cert_dir / "server.crt"),
-            "key_file": str(cert_dir / "server.key"),
-            "storage_root": str(storage_dir),
-            "manifest_ttl_seconds": 60,
-            "poll_interval_minutes": 5,
-            "max_firmware_size_kb": 3900,
-        },
-        "scheduler": {
-            "timezone": "UTC",
-            "schedules_file": str(schedules_yaml),
-        },
-        "database": {
-            "url": f"sqlite:///{tmp_path / 'test.db'}",
-        },
-        "logging": {
-            "level": "INFO",
-        },
-    }
-    config_path = config_dir / "server.yml"
-    config_path.write_text(json.dumps(server_yaml), encoding="utf-8")
-
-    monkeypatch.setenv("OTA_CONFIG", str(config_path))
-
-    from server.app import config as app_config
-
-    app_config.get_config.cache_clear()
-
-    database_module = importlib.import_module("server.app.database")
-    database_module.Base.metadata.clear()
-    if hasattr(database_module.Base, "registry"):
-        database_module.Base.registry.dispose()
-
-    modules_to_reload = [
-        "server.app.config",
-        "server.app.database",
-        "server.app.models",
-        "server.app.crud",
-        "server.app.scheduler",
-        "server.app.main",
-    ]
-    reloaded = {}
-    for module_name in modules_to_reload:
-        sys.modules.pop(module_name, None)
-        reloaded[module_name] = importlib.import_module(module_name)
-
-    from server.app import main as app_main
-
-    class DummyScheduler:
-        def start(self):
-            return None
-
-        def shutdown(self):
-            return None
-
-        def refresh_jobs(self, *args, **kwargs):
-            return None
+import orjson
+from sqlalchemy import bindparam, insert, select
+
+from server.app import crud, models
+from server.app.database import engine, session_scope
+
+# built once so every execution reuses the engine's compiled form
+_DEVICE_BY_MAC = select(models.Device).where(models.Device.mac == bindparam("mac"))
+_LOGS_BY_DEVICE = select(models.DownloadLog).where(models.DownloadLog.device_id == bindparam("device_id"))
+
+_HEADERS = {"X-OTA-Token": "test-token", "Content-Type": "application/json"}
+
+
+def _post(client, url, payload, *, headers=None):
+    """POST ``payload`` encoded with orjson, as the app encodes its responses."""
+    return client.post(url, content=orjson.dumps(payload), headers={**_HEADERS, **(headers or {})})
+
+
+def _seed_rollout(firmware, version, *, rollout_name, label="pilot", release_notes=None):
+    """Insert an active rollout of a stored firmware image in one transaction.
+
+    Args:
+        firmware: ``(stored_path, size_bytes, sha256)`` as returned by ``store_firmware_file``.
+    """
+    stored_path, size_bytes, sha256 = firmware
+    with engine.begin() as connection:
+        firmware_id = connection.execute(
+            insert(models.Firmware).returning(models.Firmware.id),
+            {
+                "version": version,
+                "version_sortkey": crud.version_sortkey(version),
+                "channel": label,
+                "file_path": str(stored_path),
+                "size_bytes": size_bytes,
+                "sha256": sha256,
+                "release_notes": release_notes,
+                "pilot_ready": True,
+            },
+        ).scalar_one()
+        label_id = connection.execute(
+            insert(models.Label).returning(models.Label.id), {"name": label}
+        ).scalar_one()
+        connection.execute(
+            insert(models.Rollout),
+            {
+                "name": rollout_name,
+                "firmware_id": firmware_id,
+                "target_label_id": label_id,
+                "stage": models.RolloutStage.pilot,
+                "status": models.RolloutStatus.active,
+                "is_active": True,
+            },
+        )
 
-    app_main._scheduler = DummyScheduler()
 
-    with TestClient(app_main.app) as client:
-        yield client, app_main
+def test_rejects_invalid_token(test_client):
+    client, _ = test_client
+    response = _post(
+        client,
+        "/api/v1/check-update",
+        {"mac": "aa:bb:cc:dd:ee:ff", "current_version": "1.0.0", "labels": []},
+        headers={"X-OTA-Token": "wrong-token"},
+    )
+    assert response.status_code == 401
 
 
 def test_check_update_no_rollout(test_client):
     client, app_main = test_client
-    response = client.post(
+    response = _post(
+        client,
         "/api/v1/check-update",
-        headers={"X-OTA-Token": "test-token"},
-        json={
+        {
             "mac": "aa:bb:cc:dd:ee:ff",
             "current_version": "0.9.0",
             "labels": ["pilot"],
         },
     )
     assert response.status_code == 200
-    payload = response.json()
+    payload = orjson.loads(response.content)
     assert payload["update_available"] is False
     assert payload["manifest"] is None
 
-    from server.app import models
-    from server.app.database import session_scope
-
     with session_scope() as session:
-        device = session.execute(
-            select(models.Device).where(models.Device.mac == "aabbccddeeff")
-        ).scalar_one_or_none()
+        device = session.execute(_DEVICE_BY_MAC, {"mac": "aabbccddeeff"}).scalar_one_or_none()
         assert device is not None
         assert device.current_version == "0.9.0"
 
 
-def test_check_update_with_rollout_and_report(test_client, tmp_path):
+def test_check_update_with_rollout_and_report(test_client, sample_firmware):
     client, app_main = test_client
-    from server.app import crud, models
-    from server.app.database import session_scope
-    from server.app.storage import store_firmware_file
 
-    firmware_path = tmp_path / "firmware.bin"
-    firmware_path.write_bytes(b"test-binary")
+    _seed_rollout(sample_firmware, "1.0.0", rollout_name="pilot-rollout", release_notes="Test build")
 
-    stored_path, size_bytes, sha256 = store_firmware_file(firmware_path, "1.0.0")
-
-    with session_scope() as session:
-        firmware = crud.create_firmware(
-            session,
-            version="1.0.0",
-            channel="pilot",
-            file_path=str(stored_path),
-            size_bytes=size_bytes,
-            sha256=sha256,
-            release_notes="Test build",
-            pilot_ready=True,
-        )
-        label = session.execute(
-            select(models.Label).where(models.Label.name == "pilot")
-        ).scalar_one_or_none()
-        if not label:
-            label = models.Label(name="pilot")
-            session.add(label)
-            session.flush()
-        rollout = crud.create_rollout(
-            session,
-            name="pilot-rollout",
-            firmware=firmware,
-            target_label=label,
-            stage=models.RolloutStage.pilot,
-            status=models.RolloutStatus.active,
-        )
-        crud.set_rollout_status(session, rollout, status=models.RolloutStatus.active, is_active=True)
-
-    response = client.post(
+    response = _post(
+        client,
         "/api/v1/check-update",
-        headers={"X-OTA-Token": "test-token"},
-        json={
+        {
             "mac": "aa:bb:cc:dd:ee:11",
             "current_version": "0.9.0",
             "labels": ["pilot"],
         },
     )
     assert response.status_code == 200
-    payload = response.json()
+    payload = orjson.loads(response.content)
     assert payload["update_available"] is True
     manifest = payload["manifest"]
     assert manifest["version"] == "1.0.0"
-    assert manifest["sha256"] == sha256
+    assert manifest["sha256"] == sample_firmware[2]
 
-    report = client.post(
+    report = _post(
+        client,
         "/api/v1/report-status",
-        headers={"X-OTA-Token": "test-token"},
-        json={
+        {
             "mac": "aa:bb:cc:dd:ee:11",
             "firmware_version": "1.0.0",
             "status": "success",
         },
     )
     assert report.status_code == 200
+    device = orjson.loads(report.content)["device"]
+    assert device["current_version"] == "1.0.0"
+    client.portal.call(app_main._download_log_writer.flush)
 
-    from server.app.database import session_scope as scope2
-    with scope2() as session:
-        device = session.execute(
-            select(models.Device).where(models.Device.mac == "aabbccddee11")
-        ).scalar_one()
-        assert device.current_version == "1.0.0"
-        logs = session.execute(
-            select(models.DownloadLog).where(models.DownloadLog.device_id == device.id)
-        ).scalars().all()
+    with session_scope() as session:
+        logs = session.execute(_LOGS_BY_DEVICE, {"device_id": device["id"]}).scalars().all()
         statuses = [entry.status.value for entry in logs]
         assert "downloading" in statuses
         assert "success" in statuses
 
 
-def test_check_update_uses_forwarded_https_in_manifest(test_client, tmp_path):
+def test_check_update_uses_forwarded_https_in_manifest(test_client, sample_firmware):
+    client, app_main = test_client
+
+    _seed_rollout(sample_firmware, "1.0.1", rollout_name="forwarded-rollout", release_notes="Forwarded URL test")
+
+    response = _post(
+        client,
+        "/api/v1/check-update",
+        {
+            "mac": "aa:bb:cc:dd:ee:22",
+            "current_version": "1.0.0",
+            "labels": ["pilot"],
+        },
+        headers={"Host": "pms-ota.rakuxio.com", "X-Forwarded-Proto": "https"},
+    )
+    assert response.status_code == 200
+    payload = orjson.loads(response.content)
+    assert payload["update_available"] is True
+    assert payload["manifest"]["url"] == "https://pms-ota.rakuxio.com/firmware/1.0.1/image.bin"
+
+
+def test_check_update_offers_newest_eligible_firmware(test_client, tmp_path):
+    client, app_main = test_client
+
+    with session_scope() as session:
+        label = models.Label(name="pilot")
+        session.add(label)
+        for version in ("1.2.0", "1.10.0", "0.9.0"):
+            firmware = crud.create_firmware(
+                session,
+                version=version,
+                channel="pilot",
+                file_path=str(tmp_path / f"{version}.bin"),
+                size_bytes=1,
+                sha256=version,
+                release_notes=None,
+                pilot_ready=True,
+            )
+            crud.create_rollout(
+                session,
+                name=f"rollout-{version}",
+                firmware=firmware,
+                target_label=label,
+                stage=models.RolloutStage.pilot,
+                status=models.RolloutStatus.active,
+            )
+
+    def check(current_version):
+        response = _post(
+            client,
+            "/api/v1/check-update",
+            {"mac": "aa:bb:cc:dd:ee:33", "current_version": current_version, "labels": ["pilot"]},
+        )
+        assert response.status_code == 200
+        return orjson.loads(response.content)
+
+    assert check("1.0.0")["manifest"]["version"] == "1.10.0"
+    assert check("1.10.0")["update_available"] is False
+
+
+def test_check_update_never_offers_a_downgrade(test_client, sample_firmware):
+    client, _ = test_client
+    _seed_rollout(sample_firmware, "1.0.0", rollout_name="pilot-rollout")
+
+    for current_version in ("2.0.0.0.1", "20241015.1", "not-a-version"):
+        response = _post(
+            client,
+            "/api/v1/check-update",
+            {"mac": "aa:bb:cc:dd:ee:77", "current_version": current_version, "labels": ["pilot"]},
+        )
+        assert response.status_code == 200
+        assert orjson.loads(response.content)["update_available"] is False
+
+
+def test_check_update_cache_is_invalidated_by_rollout_changes(test_client, tmp_path):
     client, app_main = test_client
-    from server.app import crud, models
-    from server.app.database import session_scope
-    from server.app.storage import store_firmware_file
 
-    firmware_path = tmp_path / "firmware.bin"
-    firmware_path.write_bytes(b"forwarded-test-binary")
+    def check():
+        response = _post(
+            client,
+            "/api/v1/check-update",
+            {"mac": "aa:bb:cc:dd:ee:44", "current_version": "1.0.0", "labels": ["canary"]},
+        )
+        assert response.status_code == 200
+        return orjson.loads(response.content)
 
-    stored_path, size_bytes, sha256 = store_firmware_file(firmware_path, "1.0.1")
+    assert check()["update_available"] is False
 
     with session_scope() as session:
         firmware = crud.create_firmware(
             session,
-            version="1.0.1",
-            channel="pilot",
-            file_path=str(stored_path),
-            size_bytes=size_bytes,
-            sha256=sha256,
-            release_notes="Forwarded URL test",
-            pilot_ready=True,
+            version="1.1.0",
+            channel=None,
+            file_path=str(tmp_path / "1.1.0.bin"),
+            size_bytes=1,
+            sha256="abc",
+            release_notes=None,
+            pilot_ready=False,
         )
-        label = session.execute(
-            select(models.Label).where(models.Label.name == "pilot")
-        ).scalar_one_or_none()
-        if not label:
-            label = models.Label(name="pilot")
-            session.add(label)
-            session.flush()
         rollout = crud.create_rollout(
             session,
-            name="forwarded-rollout",
+            name="canary-rollout",
             firmware=firmware,
-            target_label=label,
-            stage=models.RolloutStage.pilot,
-            status=models.RolloutStatus.active,
+            target_label=crud.get_label(session, "canary"),
+            stage=models.RolloutStage.general,
         )
-        crud.set_rollout_status(session, rollout, status=models.RolloutStatus.active, is_active=True)
 
-    response = client.post(
+    assert check()["update_available"] is False
+
+    with session_scope() as session:
+        rollout = session.merge(rollout)
+        crud.set_rollout_status(session, rollout, status=models.RolloutStatus.active)
+
+    assert check()["manifest"]["version"] == "1.1.0"
+
+
+def test_check_update_treats_unlabelled_devices_as_general(test_client, tmp_path):
+    client, app_main = test_client
+
+    with session_scope() as session:
+        for version, label_name in (("2.0.0", "pilot"), ("1.5.0", "general")):
+            firmware = crud.create_firmware(
+                session,
+                version=version,
+                channel=None,
+                file_path=str(tmp_path / f"{version}.bin"),
+                size_bytes=1,
+                sha256=version,
+                release_notes=None,
+                pilot_ready=False,
+            )
+            label = models.Label(name=label_name)
+            session.add(label)
+            crud.create_rollout(
+                session,
+                name=f"{label_name}-rollout",
+                firmware=firmware,
+                target_label=label,
+                stage=models.RolloutStage.general,
+                status=models.RolloutStatus.active,
+            )
+
+    response = _post(
+        client,
         "/api/v1/check-update",
-        headers={
-            "X-OTA-Token": "test-token",
-            "Host": "pms-ota.rakuxio.com",
-            "X-Forwarded-Proto": "https",
-        },
-        json={
-            "mac": "aa:bb:cc:dd:ee:22",
-            "current_version": "1.0.0",
-            "labels": ["pilot"],
-        },
+        {"mac": "aa:bb:cc:dd:ee:55", "current_version": "1.0.0", "labels": []},
     )
     assert response.status_code == 200
-    payload = response.json()
-    assert payload["update_available"] is True
-    assert payload["manifest"]["url"] == "https://pms-ota.rakuxio.com/firmware/1.0.1/image.bin"
+    assert orjson.loads(response.content)["manifest"]["version"] == "1.5.0"
+
+
+def test_download_firmware_honours_etag(test_client, sample_firmware):
+    client, _ = test_client
+
+    stored_path, size_bytes, sha256 = sample_firmware
+    with session_scope() as session:
+        crud.create_firmware(
+            session,
+            version="3.0.0",
+            channel="general",
+            file_path=str(stored_path),
+            size_bytes=size_bytes,
+            sha256=sha256,
+            release_notes=None,
+            pilot_ready=False,
+        )
+
+    response = client.get("/firmware/3.0.0/image.bin", headers={"X-OTA-Token": "test-token"})
+    assert response.status_code == 200
+    assert response.content == stored_path.read_bytes()
+    assert response.headers["etag"] == f'"{sha256}"'
+    assert "immutable" in response.headers["cache-control"]
+
+    cached = client.get(
+        "/firmware/3.0.0/image.bin",
+        headers={"X-OTA-Token": "test-token", "If-None-Match": f'"{sha256}"'},
+    )
+    assert cached.status_code == 304
+    assert cached.content == b""
+
+
+def test_report_status_rejects_unknown_device_and_firmware(test_client):
+    client, _ = test_client
+    report = {"mac": "aa:bb:cc:dd:ee:42", "firmware_version": "9.9.9", "status": "success"}
+
+    response = _post(client, "/api/v1/report-status", report)
+    assert response.status_code == 404
+    assert orjson.loads(response.content)["detail"] == "Device not registered"
+
+    _post(client, "/api/v1/check-update", {"mac": report["mac"], "current_version": "1.0.0", "labels": []})
+    response = _post(client, "/api/v1/report-status", report)
+    assert response.status_code == 404
+    assert orjson.loads(response.content)["detail"] == "Firmware not tracked"
+
+
+def test_report_status_forgets_cached_device_after_deletion(test_client, sample_firmware):
+    client, _ = test_client
+    _seed_rollout(sample_firmware, "1.0.0", rollout_name="pilot-rollout")
+    report = {"mac": "aa:bb:cc:dd:ee:66", "firmware_version": "1.0.0", "status": "success"}
+
+    _post(client, "/api/v1/check-update", {"mac": report["mac"], "current_version": "0.9.0", "labels": ["pilot"]})
+    assert client.get("/firmware/1.0.0/image.bin", headers=_HEADERS).status_code == 200
+    assert _post(client, "/api/v1/report-status", report).status_code == 200
+
+    with engine.begin() as connection:
+        connection.execute(models.Device.__table__.delete())
+
+    for _ in range(2):
+        response = _post(client, "/api/v1/report-status", report)
+        assert response.status_code == 404
+        assert orjson.loads(response.content)["detail"] == "Device not registered"
+
+    # registering again under the same MAC creates a new id, which reports must use
+    _post(client, "/api/v1/check-update", {"mac": report["mac"], "current_version": "0.9.0", "labels": ["pilot"]})
+    response = _post(client, "/api/v1/report-status", report)
+    assert response.status_code == 200
+    with session_scope() as session:
+        device = session.execute(_DEVICE_BY_MAC, {"mac": "aabbccddee66"}).scalar_one()
+    assert orjson.loads(response.content)["device"]["id"] == device.id
+
+
+def test_report_status_finds_a_device_registered_again_by_another_worker(test_client, sample_firmware):
+    client, _ = test_client
+    _seed_rollout(sample_firmware, "1.0.0", rollout_name="pilot-rollout")
+    report = {"mac": "aa:bb:cc:dd:ee:67", "firmware_version": "1.0.0", "status": "success"}
+
+    _post(client, "/api/v1/check-update", {"mac": report["mac"], "current_version": "0.9.0", "labels": ["pilot"]})
+    assert _post(client, "/api/v1/report-status", report).status_code == 200
+
+    # the device is deleted and recreated without this process seeing the check-in
+    with engine.begin() as connection:
+        connection.execute(models.Device.__table__.delete())
+        connection.execute(insert(models.Device), {"mac": "aabbccddee67", "current_version": "0.9.0"})
+
+    response = _post(client, "/api/v1/report-status", report)
+    assert response.status_code == 200
+    assert orjson.loads(response.content)["device"]["current_version"] == "1.0.0"
+
+
+def test_report_status_failure_keeps_the_installed_version(test_client, sample_firmware):
+    client, _ = test_client
+    _seed_rollout(sample_firmware, "1.0.0", rollout_name="pilot-rollout")
+
+    _post(client, "/api/v1/check-update", {"mac": "aa:bb:cc:dd:ee:68", "current_version": "0.9.0", "labels": ["pilot"]})
+    response = _post(
+        client,
+        "/api/v1/report-status",
+        {"mac": "aa:bb:cc:dd:ee:68", "firmware_version": "1.0.0", "status": "failed", "error": "flash write"},
+    )
+    assert response.status_code == 200
+    assert orjson.loads(response.content)["device"]["current_version"] == "0.9.0"
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import itertools
+
+import pytest
+from packaging.version import Version
+from sqlalchemy import insert, select
+
+from server.app import crud, models
+from server.app.crud import version_sortkey
+from server.app.database import engine, session_scope
+
+
+def test_version_sortkey_matches_packaging_order():
+    versions = [
+        "0.0.9",
+        "0.0.68",
+        "1.0.dev1",
+        "1.0a1.dev1",
+        "1.0a1",
+        "1.0b2",
+        "1.0rc1",
+        "1.0",
+        "1.0.post1",
+        "1.0.1",
+        "1.0.10",
+        "1.0.0.1",
+        "1.0.0.0.0.1",
+        "1.123456789",
+        "1.1234567890",
+        "2.0",
+        "2.0.0.0.1",
+        "20241015.1",
+        "20241015.2",
+        "2024101512.1",
+        "1!0.1",
+    ]
+    for left, right in itertools.permutations(versions, 2):
+        assert (Version(left) < Version(right)) == (version_sortkey(left) < version_sortkey(right))
+
+
+def test_version_sortkey_ignores_trailing_zeros():
+    assert version_sortkey("1.0") == version_sortkey("1.0.0.0")
+
+
+def test_version_sortkey_rejects_invalid_versions():
+    with pytest.raises(ValueError):
+        version_sortkey("not-a-version")
+
+
+def test_backfill_reencodes_keys_and_skips_invalid_versions(test_client):
+    with engine.begin() as connection:
+        connection.execute(
+            insert(models.Firmware),
+            [
+                {"version": version, "version_sortkey": key, "file_path": version, "size_bytes": 1, "sha256": version}
+                # a key in the old fixed-width format, one never filled in, and an invalid version
+                for version, key in (("1.0.0", "000.00001.00000"), ("2.0.0.0.1", None), ("not-a-version", None))
+            ],
+        )
+
+    with session_scope() as session:
+        assert crud.backfill_version_sortkeys(session) == 2
+
+    with session_scope() as session:
+        keys = dict(session.execute(select(models.Firmware.version, models.Firmware.version_sortkey)).all())
+    assert keys == {
+        "1.0.0": version_sortkey("1.0.0"),
+        "2.0.0.0.1": version_sortkey("2.0.0.0.1"),
+        "not-a-version": None,
+    }
+
+
+def test_rollout_changes_clear_the_manifest_cache_only_once_committed(test_client, tmp_path):
+    with session_scope() as session:
+        firmware = crud.create_firmware(
+            session,
+            version="1.0.0",
+            channel=None,
+            file_path=str(tmp_path / "1.0.0.bin"),
+            size_bytes=1,
+            sha256="abc",
+            release_notes=None,
+            pilot_ready=False,
+        )
+        generation = crud._manifest_cache_generation
+        rollout = crud.create_rollout(
+            session, name="general-rollout", firmware=firmware, target_label=None, stage=models.RolloutStage.general
+        )
+        assert crud._manifest_cache_generation == generation
+    assert crud._manifest_cache_generation == generation + 1
+
+    with pytest.raises(RuntimeError), session_scope() as session:
+        crud.set_rollout_status(session, session.merge(rollout), status=models.RolloutStatus.active)
+        raise RuntimeError("abort")
+    assert crud._manifest_cache_generation == generation + 1
+
+
+def test_label_and_schedule_writes_work_without_on_conflict(test_client, tmp_path, monkeypatch):
+    # stands in for dialects such as MySQL that have no ON CONFLICT clause
+    monkeypatch.delitem(crud._UPSERT_INSERTS, "sqlite")
+
+    for _ in range(2):
+        with session_scope() as session:
+            device, labels = crud.register_or_update_device(
+                session, mac="aabbccddee88", ip=None, current_version="1.0.0", label_names=["pilot", "lab"]
+            )
+        assert labels == {"pilot", "lab"}
+
+    with session_scope() as session:
+        firmware = crud.create_firmware(
+            session,
+            version="1.0.0",
+            channel=None,
+            file_path=str(tmp_path / "1.0.0.bin"),
+            size_bytes=1,
+            sha256="abc",
+            release_notes=None,
+            pilot_ready=False,
+        )
+        rollout = crud.create_rollout(
+            session, name="nightly", firmware=firmware, target_label=None, stage=models.RolloutStage.general
+        )
+    for cron in ("0 3 * * *", "0 4 * * *"):
+        with session_scope() as session:
+            crud.upsert_schedules(
+                session, [{"name": "nightly-job", "cron": cron, "enabled": True, "rollout_id": rollout.id}]
+            )
+
+    with session_scope() as session:
+        # a row inserted concurrently is skipped without aborting the transaction
+        crud._insert_ignoring_conflicts(
+            session, models.Label, [{"name": "pilot"}, {"name": "field"}], index_elements=[models.Label.name]
+        )
+
+    with session_scope() as session:
+        assert len(session.execute(select(models.DeviceLabel.id)).all()) == 2
+        assert set(session.execute(select(models.Label.name)).scalars()) == {"pilot", "lab", "field"}
+        assert session.execute(select(models.Schedule.cron)).scalars().all() == ["0 4 * * *"]
+
+
+def test_register_or_update_device_replaces_labels_and_keeps_them_when_none_are_sent(test_client):
+    def register(label_names):
+        with session_scope() as session:
+            device, labels = crud.register_or_update_device(
+                session, mac="aabbccddee99", ip=None, current_version="1.0.0", label_names=label_names
+            )
+            stored = set(
+                session.execute(
+                    select(models.Label.name)
+                    .join(models.DeviceLabel, models.DeviceLabel.label_id == models.Label.id)
+                    .where(models.DeviceLabel.device_id == device.id)
+                ).scalars()
+            )
+        return labels, stored
+
+    assert register(["a", "b"]) == ({"a", "b"}, {"a", "b"})
+    assert register(["b", "c"]) == ({"b", "c"}, {"b", "c"})
+    assert register([]) == ({"b", "c"}, {"b", "c"})
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from server.app import models
+from server.app.download_log import DownloadLogWriter
+
+
+def _writer(monkeypatch, *, batch_size: int, flush_ms: int) -> tuple[DownloadLogWriter, list[list[dict]]]:
+    """Build a writer that hands its batches to a list instead of the database."""
+    batches: list[list[dict]] = []
+    monkeypatch.setattr(DownloadLogWriter, "_insert", staticmethod(lambda rows: batches.append(list(rows))))
+    writer = DownloadLogWriter()
+    writer.batch_size = batch_size
+    writer.flush_interval = flush_ms / 1000
+    return writer, batches
+
+
+def _record(writer: DownloadLogWriter, count: int) -> None:
+    for device_id in range(count):
+        writer.record(None, device_id=device_id, firmware_id=1, status=models.DownloadStatus.downloading)
+
+
+@pytest.mark.asyncio
+async def test_writer_writes_full_batches_and_flushes_the_rest_on_shutdown(monkeypatch):
+    writer, batches = _writer(monkeypatch, batch_size=3, flush_ms=3_600_000)
+    writer.start()
+
+    _record(writer, 7)
+    for _ in range(100):
+        if len(batches) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert [len(batch) for batch in batches] == [3, 3]
+
+    await writer.shutdown()
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [row["device_id"] for batch in batches for row in batch] == list(range(7))
+
+
+@pytest.mark.asyncio
+async def test_writer_flushes_a_partial_batch_after_the_interval(monkeypatch):
+    writer, batches = _writer(monkeypatch, batch_size=1000, flush_ms=20)
+    writer.start()
+
+    _record(writer, 2)
+    for _ in range(100):
+        if batches:
+            break
+        await asyncio.sleep(0.01)
+    assert [len(batch) for batch in batches] == [2]
+
+    await writer.shutdown()
+    assert len(batches) == 1
+
+
+@pytest.mark.asyncio
+async def test_writer_keeps_valid_rows_when_a_batch_fails(monkeypatch):
+    written: list[dict] = []
+
+    def insert(rows):
+        if any(row["device_id"] == 1 for row in rows):
+            raise RuntimeError("foreign key violation")
+        written.extend(rows)
+
+    monkeypatch.setattr(DownloadLogWriter, "_insert", staticmethod(insert))
+    writer = DownloadLogWriter()
+    writer.start()
+
+    _record(writer, 3)
+    await writer.shutdown()
+    assert [row["device_id"] for row in written] == [0, 2]
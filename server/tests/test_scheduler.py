@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import json
+
+from sqlalchemy import select
+
+from server.app import crud, models
+from server.app.database import session_scope
+from server.app.scheduler import RolloutScheduler
+
+
+def test_refresh_jobs_syncs_schedules_from_json(test_client, tmp_path, caplog):
+    with session_scope() as session:
+        firmware = crud.create_firmware(
+            session,
+            version="1.0.0",
+            channel=None,
+            file_path=str(tmp_path / "1.0.0.bin"),
+            size_bytes=1,
+            sha256="abc",
+            release_notes=None,
+            pilot_ready=False,
+        )
+        crud.create_rollout(
+            session,
+            name="nightly",
+            firmware=firmware,
+            target_label=None,
+            stage=models.RolloutStage.general,
+        )
+
+    schedules_file = tmp_path / "schedules.json"
+    schedules_file.write_text(
+        json.dumps(
+            {
+                "schedules": [
+                    {"name": "nightly-job", "rollout": "nightly", "cron": "0 2 * * *"},
+                    {"name": "nightly-job", "rollout": "nightly", "cron": "0 3 * * *"},
+                    {"name": "orphan-job", "rollout": "missing", "cron": "0 4 * * *"},
+                ]
+            }
+        ),
+        encoding="utf-8",
+    )
+    scheduler = RolloutScheduler()
+    scheduler.config = scheduler.config.model_copy(
+        update={"scheduler": scheduler.config.scheduler.model_copy(update={"schedules_file": str(schedules_file)})}
+    )
+    scheduler.refresh_jobs(apply_jobs=False)
+
+    with session_scope() as session:
+        schedules = session.execute(select(models.Schedule)).scalars().all()
+        assert [(schedule.name, schedule.cron, schedule.enabled) for schedule in schedules] == [
+            ("nightly-job", "0 3 * * *", True)
+        ]
+    assert "Schedule 'nightly-job' is defined more than once" in caplog.text
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import hashlib
+import shutil
+
+import pytest
+
+from server.app.storage import store_firmware_file
+
+
+def test_store_firmware_file_reports_source_size_and_sha256(tmp_path):
+    source = tmp_path / "image.bin"
+    source.write_bytes(bytes(range(256)) * 5000)
+
+    stored_path, size_bytes, sha256 = store_firmware_file(source, "storage-hash")
+
+    assert stored_path.read_bytes() == source.read_bytes()
+    assert size_bytes == source.stat().st_size
+    assert sha256 == hashlib.sha256(source.read_bytes()).hexdigest()
+
+
+def test_store_firmware_file_refuses_to_copy_a_file_onto_itself(tmp_path):
+    source = tmp_path / "image.bin"
+    source.write_bytes(b"firmware")
+    stored_path, _, _ = store_firmware_file(source, "storage-same-file")
+
+    with pytest.raises(shutil.SameFileError):
+        store_firmware_file(stored_path, "storage-same-file")
+    assert stored_path.read_bytes() == b"firmware"
+    assert list(stored_path.parent.iterdir()) == [stored_path]
+
+
+def test_store_firmware_file_rejects_oversized_images_without_touching_the_stored_one(tmp_path):
+    source = tmp_path / "image.bin"
+    source.write_bytes(b"firmware")
+    stored_path, _, _ = store_firmware_file(source, "storage-oversize")
+
+    source.write_bytes(b"\0" * (3900 * 1024 + 1))
+    with pytest.raises(ValueError, match="exceeds limit"):
+        store_firmware_file(source, "storage-oversize")
+    assert stored_path.read_bytes() == b"firmware"
+    assert list(stored_path.parent.iterdir()) == [stored_path]
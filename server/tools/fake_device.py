@@ -5,21 +5,36 @@ import argparse
 import asyncio
 import hashlib
 import os
+import sys
 from pathlib import Path
 from typing import Optional
 
 import httpx
 
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - uvloop is optional (not available on Windows)
+    uvloop = None
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
 
 async def download_and_verify(client: httpx.AsyncClient, url: str, token: str, expected_sha: str, dest: Path) -> Path:
     headers = {"X-OTA-Token": token}
     async with client.stream("GET", url, headers=headers) as response:
         response.raise_for_status()
         hasher = hashlib.sha256()
+        pending: asyncio.Future | None = None
         with dest.open("wb") as fh:
-            async for chunk in response.aiter_bytes():
+            async for chunk in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                # hashlib releases the GIL for large buffers, so hashing this chunk
+                # overlaps with receiving the next one
+                if pending:
+                    await pending
                 fh.write(chunk)
-                hasher.update(chunk)
+                pending = asyncio.ensure_future(asyncio.to_thread(hasher.update, chunk))
+            if pending:
+                await pending
     digest = hasher.hexdigest()
     if digest != expected_sha:
         raise ValueError(f"SHA mismatch: expected {expected_sha}, got {digest}")
@@ -27,13 +42,12 @@ async def download_and_verify(client: httpx.AsyncClient, url: str, token: str, e
 
 
 async def simulate_device(
+    client: httpx.AsyncClient,
     *,
-    base_url: str,
     mac: str,
     version: str,
     labels: list[str],
     token: str,
-    verify: Optional[str | bool],
     download_dir: Path,
 ) -> None:
     payload = {
@@ -42,39 +56,103 @@ async def simulate_device(
         "labels": labels,
     }
     headers = {"X-OTA-Token": token}
-    async with httpx.AsyncClient(base_url=base_url, verify=verify, timeout=30.0) as client:
-        response = await client.post("/api/v1/check-update", json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        print("Check update response:", data)
-        if not data.get("update_available"):
-            return
-        manifest = data["manifest"]
-        firmware_url = manifest["url"]
-        sha256 = manifest["sha256"]
-        dest = download_dir / Path(firmware_url).name
-        downloaded = await download_and_verify(client, firmware_url, token, sha256, dest)
-        print(f"Firmware downloaded to {downloaded}")
-        report_payload = {
-            "mac": mac,
-            "firmware_version": manifest["version"],
-            "status": "success",
-        }
-        report = await client.post("/api/v1/report-status", json=report_payload, headers=headers)
-        report.raise_for_status()
-        print("Reported success:", report.json())
+    response = await client.post("/api/v1/check-update", json=payload, headers=headers)
+    response.raise_for_status()
+    data = response.json()
+    print(f"[{mac}] Check update response:", data)
+    if not data.get("update_available"):
+        return
+    manifest = data["manifest"]
+    firmware_url = manifest["url"]
+    sha256 = manifest["sha256"]
+    dest = download_dir / Path(firmware_url).name
+    downloaded = await download_and_verify(client, firmware_url, token, sha256, dest)
+    print(f"[{mac}] Firmware downloaded to {downloaded}")
+    report_payload = {
+        "mac": mac,
+        "firmware_version": manifest["version"],
+        "status": "success",
+    }
+    report = await client.post("/api/v1/report-status", json=report_payload, headers=headers)
+    report.raise_for_status()
+    print(f"[{mac}] Reported success:", report.json())
+
+
+def device_macs(base_mac: str, count: int) -> list[str]:
+    """Derive ``count`` consecutive MAC addresses starting at ``base_mac``."""
+    base = int(base_mac.replace(":", "").replace("-", ""), 16)
+    macs = []
+    for offset in range(count):
+        value = f"{(base + offset) % (1 << 48):012x}"
+        macs.append(":".join(value[i:i + 2] for i in range(0, 12, 2)))
+    return macs
+
+
+async def simulate_fleet(
+    *,
+    base_url: str,
+    macs: list[str],
+    version: str,
+    labels: list[str],
+    token: str,
+    verify: Optional[str | bool],
+    http2: bool,
+    download_dir: Path,
+    concurrency: int,
+) -> int:
+    """Run every device in ``macs`` against the server.
+
+    Returns:
+        The number of devices whose simulation failed.
+    """
+    # one SSL context and one pooled client, so TLS sessions and connections are reused across devices
+    ssl_context = httpx.create_ssl_context(verify=verify) if verify is not False else False
+    limits = httpx.Limits(max_keepalive_connections=100, max_connections=200)
+    async with httpx.AsyncClient(
+        base_url=base_url,
+        verify=ssl_context,
+        http2=http2,
+        limits=limits,
+        timeout=30.0,
+    ) as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(mac: str) -> None:
+            device_dir = download_dir if len(macs) == 1 else download_dir / mac.replace(":", "")
+            device_dir.mkdir(parents=True, exist_ok=True)
+            async with semaphore:
+                await simulate_device(
+                    client,
+                    mac=mac,
+                    version=version,
+                    labels=labels,
+                    token=token,
+                    download_dir=device_dir,
+                )
+
+        # one failing device must not cancel the rest of the fleet
+        results = await asyncio.gather(*(bounded(mac) for mac in macs), return_exceptions=True)
+    failures = [(mac, result) for mac, result in zip(macs, results) if isinstance(result, Exception)]
+    for mac, error in failures:
+        print(f"[{mac}] Simulation failed: {error!r}")
+    if len(macs) > 1:
+        print(f"Simulated {len(macs)} devices; {len(failures)} failed")
+    return len(failures)
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Simulate an ESP32 device checking for OTA updates")
     parser.add_argument("--base-url", default="https://localhost:8443", help="OTA server base URL")
-    parser.add_argument("--mac", default="aa:bb:cc:dd:ee:ff", help="Device MAC address")
+    parser.add_argument("--mac", default="aa:bb:cc:dd:ee:ff", help="Device MAC address (first one when --fleet-size > 1)")
     parser.add_argument("--version", default="0.0.1", help="Current firmware version")
     parser.add_argument("--labels", nargs="*", default=["pilot"], help="Device labels")
     parser.add_argument("--token", default=os.getenv("OTA_TOKEN", "change-me"), help="API token")
     parser.add_argument("--insecure", action="store_true", help="Disable TLS verification (development only)")
     parser.add_argument("--cert", help="Path to CA bundle for TLS verification")
     parser.add_argument("--download-dir", default="./downloads", help="Directory to store downloaded firmware")
+    parser.add_argument("--fleet-size", type=int, default=1, help="Number of devices to simulate")
+    parser.add_argument("--concurrency", type=int, default=50, help="Maximum devices talking to the server at once")
+    parser.add_argument("--http2", action="store_true", help="Negotiate HTTP/2 (requires httpx[http2])")
 
     args = parser.parse_args()
 
@@ -89,17 +167,24 @@ def main() -> None:
     download_dir = Path(args.download_dir)
     download_dir.mkdir(parents=True, exist_ok=True)
 
-    asyncio.run(
-        simulate_device(
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    failures = asyncio.run(
+        simulate_fleet(
             base_url=args.base_url,
-            mac=args.mac,
+            macs=device_macs(args.mac, max(args.fleet_size, 1)),
             version=args.version,
             labels=args.labels,
             token=args.token,
             verify=verify,
+            http2=args.http2,
             download_dir=download_dir,
+            concurrency=max(args.concurrency, 1),
         )
     )
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":